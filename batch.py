@@ -0,0 +1,281 @@
+'''
+batch runs the vessel detection of process_image on every image of a folder
+(or matching a glob pattern) and writes one line per image in a CSV file.
+
+    python batch.py "images//4276" results.csv --workers 8
+
+Images already in the CSV file are skipped, so an interrupted run can be
+resumed by running the same command again. The images that failed are tried
+again, their new line being added after the line of the error.
+
+With --planes, every plane of the stacks of the .lsm files is analysed and
+written on its own line, the files being taken as a time series :
+
+    python batch.py "images//4276" planes.csv --planes --channel 0
+
+From python, the files of a time series are sorted by Lsmimage.time :
+
+>>> rows = analyse_planes([Lsmimage(path, time) for path, time in files])
+'''
+import argparse
+import csv
+import glob
+import os
+from concurrent import futures
+
+from lsmreader import Lsmimage
+from normalize import normalize
+from read_lsm import file_extension, read_lsm_image
+from vessels import measure_vessels
+
+EXTENSIONS = ('.lsm', '.jpg')
+FIELDS = ['image', 'vessels', 'average_width', 'error']
+PLANE_FIELDS = ['image', 'time', 'stack', 'channel', 'vessels',
+                'average_width', 'error']
+
+
+def find_images(source):
+    """
+    Lists the .lsm and .jpg images of a folder or matching a glob pattern
+    :param source: folder or glob pattern
+    :return: sorted list of paths
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '*')
+    return sorted(path for path in glob.glob(source)
+                  if file_extension(path) in EXTENSIONS)
+
+
+def analyse_image(path, sigma=3, mask=26, area=25, stack=0, channel=0,
+                  tile=None, percentile=100):
+    """
+    Runs the vessel detection on one image
+    :param path: path of the image
+    :param sigma: sigma of the canny edge detector
+    :param mask: pixels below this value (once scaled to 0 -> 256) are ignored
+    :param area: minimal filled area of a vessel
+    :param stack: stack to analyse in .lsm files
+    :param channel: channel to analyse in .lsm files
+    :param tile: if given, the edges are detected on tiles of tile x tile
+        pixels, to bound the memory used by big mosaics
+    :param percentile: percentile of the pixel values scaled to 256, the
+        values above it are clipped
+    :return: dictionary with the fields of the results file
+    """
+    folder, filename = os.path.split(path)
+    # Each image is read once: the plane cache would only keep dead copies
+    # in every worker.
+    if file_extension(filename) == '.lsm':
+        raw_image_data = read_lsm_image(folder, filename, cache=False,
+                                        stack=stack, channel=channel)
+    else:
+        raw_image_data = read_lsm_image(folder, filename, cache=False)
+
+    result = analyse_plane(raw_image_data, sigma, mask, area, tile,
+                           percentile)
+    result['image'] = path
+    return result
+
+
+def analyse_plane(raw_image_data, sigma=3, mask=26, area=25, tile=None,
+                  percentile=100):
+    """
+    Runs the vessel detection on one plane
+    :param raw_image_data: plane as read from the file
+    :return: dictionary with the vessels and average_width fields
+    """
+    # Put pixel values into the range 0 to 256
+    image_data = normalize(raw_image_data, percentile)
+    # The tiles are processed by a single thread, the images being already
+    # processed in parallel.
+    metrics = measure_vessels(image_data, sigma, mask, area, tile=tile,
+                              workers=1)
+    return {'vessels': metrics.count,
+            'average_width': metrics.average_width,
+            'error': ''}
+
+
+def _analyse_plane_or_fail(plane, **kwargs):
+    try:
+        return analyse_plane(plane, **kwargs)
+    except Exception as error:
+        return {'vessels': '', 'average_width': '', 'error': repr(error)}
+
+
+def _plane_order(row):
+    # Error rows, without stack, come last in their file.
+    return row['stack'] == '', row['stack'] or 0, row['channel'] or 0
+
+
+def analyse_planes(images, channel=None, workers=None, callback=None,
+                   **kwargs):
+    """
+    Runs the vessel detection on every plane of the stacks of a time series.
+    The planes are read one by one while the previous ones are analysed, so
+    that only a few planes per worker are in memory. A file that cannot be
+    read gives a row with its error, after the rows of the planes read.
+    :param images: Lsmimage objects or paths of .lsm files, analysed in the
+        order of their time (Lsmimage.time); files without time come last
+    :param channel: channel to analyse, all of them if None
+    :param workers: number of worker processes, all the cores if None
+    :param callback: function called with the rows of each file as soon as
+        all its planes are analysed, e.g. to write them
+    :param kwargs: specify kwargs to pass to analyse_plane()
+    :return: list of rows with the fields PLANE_FIELDS, in the order of the
+        time series, the stacks and the channels
+    """
+    images = [image if isinstance(image, Lsmimage) else Lsmimage(image)
+              for image in images]
+    images.sort(key=lambda image: (image.time is None, image.time))
+    rows = list()
+    file_rows = dict()
+    remaining = dict()
+
+    def finish(job):
+        row = dict(pending.pop(job), **job.result())
+        remaining[row['image']] -= 1
+        file_rows[row['image']].append(row)
+        flush(row['image'])
+
+    def flush(filename):
+        # Called once the planes of the file are read, and after each of
+        # them is analysed.
+        if remaining[filename] == 0:
+            this_rows = sorted(file_rows.pop(filename), key=_plane_order)
+            rows.extend(this_rows)
+            if callback is not None:
+                callback(this_rows)
+
+    # Planes waiting for a worker are kept in memory.
+    max_pending = 2 * (workers or os.cpu_count() or 1)
+    with futures.ProcessPoolExecutor(workers) as executor:
+        pending = dict()
+        for image in images:
+            info = {'image': image.filename, 'time': image.time}
+            file_rows[image.filename] = list()
+            # Counts one more until all the planes of the file are read.
+            remaining[image.filename] = 1
+            try:
+                for stack, this_channel, plane in image.iter_planes(channel):
+                    if len(pending) >= max_pending:
+                        done, _ = futures.wait(
+                                pending, return_when=futures.FIRST_COMPLETED)
+                        for job in done:
+                            finish(job)
+                    job = executor.submit(_analyse_plane_or_fail, plane,
+                                          **kwargs)
+                    pending[job] = dict(info, stack=stack,
+                                        channel=this_channel)
+                    remaining[image.filename] += 1
+            except Exception as error:
+                # An unreadable file must not stop the time series.
+                file_rows[image.filename].append(
+                    dict(info, stack='', channel='', vessels='',
+                         average_width='', error=repr(error)))
+            remaining[image.filename] -= 1
+            flush(image.filename)
+        for job in futures.as_completed(list(pending)):
+            finish(job)
+    order = {image.filename: rank for rank, image in enumerate(images)}
+    rows.sort(key=lambda row: (order[row['image']],) + _plane_order(row))
+    return rows
+
+
+def _analyse_or_fail(path, **kwargs):
+    # Runs in the workers: an unreadable image must not stop the batch.
+    try:
+        return analyse_image(path, **kwargs)
+    except Exception as error:
+        return {'image': path, 'vessels': '', 'average_width': '',
+                'error': repr(error)}
+
+
+def read_done(output):
+    """
+    Returns the set of images already analysed in the results file. The
+    images whose row holds an error are left out, to be tried again.
+    """
+    if not os.path.exists(output):
+        return set()
+    with open(output, newline='') as fid:
+        return set(row['image'] for row in csv.DictReader(fid)
+                   if not row['error'])
+
+
+def run_batch(source, output, workers=None, **kwargs):
+    """
+    Analyses all the images of source that are not yet in output
+    :param source: folder or glob pattern
+    :param output: CSV file, created or completed
+    :param workers: number of worker processes, all the cores if None, no
+        pool if 1
+    :param kwargs: specify kwargs to pass to analyse_image()
+    :return: number of images analysed
+    """
+    done = read_done(output)
+    paths = [path for path in find_images(source) if path not in done]
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, 'a', newline='') as fid:
+        writer = csv.DictWriter(fid, FIELDS)
+        if new_file:
+            writer.writeheader()
+        if workers == 1:
+            results = (_analyse_or_fail(path, **kwargs) for path in paths)
+            for result in results:
+                writer.writerow(result)
+                fid.flush()
+        else:
+            with futures.ProcessPoolExecutor(workers) as executor:
+                jobs = [executor.submit(_analyse_or_fail, path, **kwargs)
+                        for path in paths]
+                # Each line is written as soon as its image is done, so that
+                # a crash only loses the images being processed.
+                for job in futures.as_completed(jobs):
+                    writer.writerow(job.result())
+                    fid.flush()
+    return len(paths)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs the vessel detection on a folder of images')
+    parser.add_argument('source', help='folder or glob pattern of the images')
+    parser.add_argument('output', help='CSV file of the results')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--sigma', type=float, default=3)
+    parser.add_argument('--mask', type=float, default=26)
+    parser.add_argument('--area', type=float, default=25)
+    parser.add_argument('--stack', type=int, default=0)
+    parser.add_argument('--channel', type=int, default=0)
+    parser.add_argument('--tile', type=int, default=None,
+                        help='size of the tiles for big images')
+    parser.add_argument('--percentile', type=float, default=100,
+                        help='percentile of the pixel values scaled to 256')
+    parser.add_argument('--planes', action='store_true',
+                        help='analyse every plane of the .lsm files')
+    args = parser.parse_args()
+    if args.planes:
+        paths = [path for path in find_images(args.source)
+                 if file_extension(path) == '.lsm']
+        with open(args.output, 'w', newline='') as fid:
+            writer = csv.DictWriter(fid, PLANE_FIELDS)
+            writer.writeheader()
+
+            def write_rows(file_rows):
+                # Each file is written as soon as it is done, so that a
+                # crash only loses the files being processed.
+                writer.writerows(file_rows)
+                fid.flush()
+
+            rows = analyse_planes(paths, args.channel, args.workers,
+                                  callback=write_rows, sigma=args.sigma,
+                                  mask=args.mask, area=args.area,
+                                  tile=args.tile, percentile=args.percentile)
+        print(f'{len(rows)} planes analysed')
+    else:
+        nb_images = run_batch(args.source, args.output, args.workers,
+                              sigma=args.sigma, mask=args.mask,
+                              area=args.area, stack=args.stack,
+                              channel=args.channel, tile=args.tile,
+                              percentile=args.percentile)
+        print(f'{nb_images} images analysed')
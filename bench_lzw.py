@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_lzw compares the LZW decoders of the lzw module on synthetic strips,
+and measures the speed of lzw.unpackints for bit widths from 1 to 32.
+
+>>> python bench_lzw.py
+'''
+import timeit
+
+import numpy
+
+import lzw
+
+
+def encodelzw(decoded):
+    '''
+    Compress a byte string the way TIFF writers do (MSB first, early
+    change), so that synthetic strips can be fed to the decoders.
+    '''
+    def width(nb_codes):
+        # The decoder adds an entry for every code but the first one after a
+        # CLEAR and switches width one entry earlier than the encoder.
+        lentable = 258 + max(nb_codes - 1, 0)
+        if lentable < 511:
+            return 9
+        elif lentable < 1023:
+            return 10
+        elif lentable < 2047:
+            return 11
+        return 12
+
+    codes = list()
+
+    def emit(code):
+        codes.append((code, width(emitted[0])))
+        emitted[0] += 1
+
+    emitted = [0]
+    emit(256)
+    emitted[0] = 0
+    table = dict((bytes((i,)), i) for i in range(256))
+    next_code = 258
+    string = b''
+    for value in decoded:
+        char = bytes((value,))
+        if string + char in table:
+            string += char
+            continue
+        emit(table[string])
+        table[string + char] = next_code
+        next_code += 1
+        string = char
+        if next_code == 4094:
+            emit(table[string])
+            string = b''
+            emit(256)
+            emitted[0] = 0
+            table = dict((bytes((i,)), i) for i in range(256))
+            next_code = 258
+    if string:
+        emit(table[string])
+    emit(257)
+
+    encoded = bytearray()
+    bits = 0
+    nb_bits = 0
+    for code, bitw in codes:
+        bits = (bits << bitw) | code
+        nb_bits += bitw
+        while nb_bits >= 8:
+            nb_bits -= 8
+            encoded.append(bits >> nb_bits)
+            bits &= (1 << nb_bits) - 1
+    if nb_bits:
+        encoded.append(bits << (8 - nb_bits))
+    return bytes(encoded)
+
+
+def synthetic_strip(width=512, length=512, seed=0):
+    '''
+    Returns a 16 bit plane looking like a microscope image (smooth signal
+    plus noise) as bytes, together with its LZW encoded version.
+    '''
+    rand = numpy.random.RandomState(seed)
+    x = numpy.linspace(0, 8 * numpy.pi, width)
+    signal = 800 + 600 * numpy.outer(numpy.sin(x[:length]), numpy.cos(x))
+    noise = rand.poisson(20, (length, width))
+    plane = (signal + noise).astype(numpy.uint16)
+    decoded = plane.tobytes()
+    return decoded, encodelzw(decoded)
+
+
+def run(width=512, length=512, repeat=3):
+    '''
+    Times both decoders on the same strip and prints the throughput.
+    '''
+    decoded, encoded = synthetic_strip(width, length)
+    size = len(decoded)
+    assert lzw.decodelzw(encoded) == decoded
+    assert lzw.decodelzw_buffer(encoded, size) == decoded
+    print(f'Strip {width}x{length} 16 bit: {size} bytes, '
+          f'{len(encoded)} compressed')
+    for name, function in (('decodelzw', lambda: lzw.decodelzw(encoded)),
+                           ('decodelzw_buffer',
+                            lambda: lzw.decodelzw_buffer(encoded, size))):
+        best = min(timeit.repeat(function, number=1, repeat=repeat))
+        print(f'{name:>18}: {best * 1e3:8.1f} ms '
+              f'({size / best / 1e6:6.1f} MB/s)')
+
+
+def packints(values, intsize, runlen=0):
+    '''
+    Packs integers most significant bit first, each run of runlen integers
+    being padded to the next byte. Reference for lzw.unpackints.
+    '''
+    if runlen == 0:
+        runlen = len(values)
+    encoded = bytearray()
+    for start in range(0, len(values), runlen):
+        bits = 0
+        for value in values[start:start + runlen]:
+            bits = (bits << intsize) | int(value)
+        nb_bits = intsize * len(values[start:start + runlen])
+        padding = -nb_bits % 8
+        encoded += (bits << padding).to_bytes((nb_bits + padding) // 8, 'big')
+    return bytes(encoded)
+
+
+def run_unpackints(size=2 ** 20, runlen=1000, repeat=3):
+    '''
+    Times lzw.unpackints on size bytes of packed data for every bit width.
+    '''
+    rand = numpy.random.RandomState(0)
+    print(f'unpackints on {size} bytes, runs of {runlen} integers')
+    for intsize in range(1, 33):
+        dtype = numpy.uint8 if intsize <= 8 else (
+                numpy.uint16 if intsize <= 16 else numpy.uint32)
+        values = rand.randint(0, 2 ** intsize, 64, dtype=numpy.uint64)
+        assert numpy.array_equal(
+            lzw.unpackints(packints(values, intsize, 16), dtype, intsize, 16),
+            values)
+        data = rand.bytes(size)
+        best = min(timeit.repeat(
+            lambda: lzw.unpackints(data, dtype, intsize, runlen),
+            number=1, repeat=repeat))
+        print(f'{intsize:>18} bits: {best * 1e3:8.1f} ms '
+              f'({size / best / 1e6:6.1f} MB/s)')
+
+
+if __name__ == '__main__':
+    for shape in (256, 512, 1024):
+        run(shape, shape)
+    run_unpackints()
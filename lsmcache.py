@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+lsmcache keeps the decoded channels of LSM files on disk, so that the next
+opens memory map them instead of decoding the file again.
+
+>>> cache = Diskcache('/tmp/lsm_cache', max_bytes=20 * 2 ** 30)
+>>> imageFile = Lsmimage(LSM_FILE)
+>>> imageFile.open(cache=cache)
+
+Each entry is a directory named after the hash of the file content and of
+the offsets of its strips. It holds an index.json file and, for every
+channel, the planes in chunks of chunk_size planes saved as .npy files of
+shape (planes, width, length), so that every plane is contiguous on disk.
+'''
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+# Prefix of the entries being written.
+TMP_PREFIX = '.tmp'
+# Age in seconds after which an entry being written is considered left by
+# an interrupted process; younger ones may still be written by another one.
+TMP_AGE = 3600
+
+
+class Diskcache:
+    '''
+    Cache of decoded channels in directory. When the entries take more than
+    max_bytes, the least recently used ones are removed.
+    '''
+
+    def __init__(self, directory, max_bytes=None, chunk_size=16):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.__hashes = dict()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filename, index):
+        '''
+        Returns the key of a file : the hash of its content and of the
+        offsets of its strips (index as built by lsmparse.build_index). The
+        hash is only computed once per version of the file.
+        '''
+        status = os.stat(filename)
+        file_id = (os.path.abspath(filename), status.st_mtime_ns,
+                   status.st_size)
+        if file_id not in self.__hashes:
+            digest = hashlib.sha1()
+            with open(filename, 'rb') as fid:
+                for block in iter(lambda: fid.read(2 ** 20), b''):
+                    digest.update(block)
+            self.__hashes[file_id] = digest
+        digest = self.__hashes[file_id].copy()
+        digest.update(repr(sorted(index.items())).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        '''
+        Returns the chunks of each channel of the entry, memory mapped, or
+        None if there is no such entry. All the chunks of a channel but the
+        last one have the same number of planes.
+        '''
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'index.json')) as fid:
+                index = json.load(fid)
+            data = [[numpy.load(os.path.join(entry, name), mmap_mode='r')
+                     for name in names]
+                    for names in index['chunks']]
+        except (OSError, ValueError):
+            return None
+        # The modification time of the index tells when it was last used.
+        os.utime(os.path.join(entry, 'index.json'))
+        return data
+
+    def store(self, key, data):
+        '''
+        Stores the channels in data (arrays of shape (width, length, planes))
+        under key, then removes the least recently used entries if the cache
+        is too big.
+        '''
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+        # The entry is written aside and renamed once complete, so that an
+        # interrupted write never leaves a partial entry.
+        tmp_entry = tempfile.mkdtemp(dir=self.directory, prefix=TMP_PREFIX)
+        index = {'chunks': list(), 'nbytes': 0}
+        try:
+            for channel, volume in enumerate(data):
+                names = list()
+                for start in range(0, volume.shape[2], self.chunk_size):
+                    name = 'c%d_z%d.npy' % (channel, start)
+                    chunk = volume[:, :, start:start + self.chunk_size]
+                    numpy.save(os.path.join(tmp_entry, name),
+                               numpy.ascontiguousarray(
+                                   chunk.transpose(2, 0, 1)))
+                    index['nbytes'] += chunk.nbytes
+                    names.append(name)
+                index['chunks'].append(names)
+            with open(os.path.join(tmp_entry, 'index.json'), 'w') as fid:
+                json.dump(index, fid)
+        except BaseException:
+            # e.g. the disk is full.
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Stored in the meantime by another process.
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.cleanup(keep=key)
+
+    def cleanup(self, keep=None):
+        '''
+        Removes the entries left by the writes interrupted more than
+        TMP_AGE seconds ago, then the least recently used entries until the
+        cache fits in max_bytes. The entry keep is never removed.
+        '''
+        now = time.time()
+        for key in os.listdir(self.directory):
+            if not key.startswith(TMP_PREFIX):
+                continue
+            tmp_entry = os.path.join(self.directory, key)
+            try:
+                if now - os.path.getmtime(tmp_entry) > TMP_AGE:
+                    shutil.rmtree(tmp_entry, ignore_errors=True)
+            except OSError:
+                # Renamed or removed in the meantime.
+                pass
+        if self.max_bytes is None:
+            return
+        entries = list()
+        total = 0
+        for key in os.listdir(self.directory):
+            index_name = os.path.join(self.directory, key, 'index.json')
+            try:
+                with open(index_name) as fid:
+                    nbytes = json.load(fid)['nbytes']
+                last_used = os.path.getmtime(index_name)
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((last_used, key, nbytes))
+            total += nbytes
+        for last_used, key, nbytes in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
+            total -= nbytes
+
+    def clear(self):
+        '''
+        Removes all the entries.
+        '''
+        for key in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, key),
+                          ignore_errors=True)
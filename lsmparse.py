@@ -4,7 +4,7 @@
 lsmparse is used to parse the lsm files in order to extract the image matrices
 '''
 
-from struct import unpack
+from struct import pack, unpack
 
 import numpy
 
@@ -83,66 +83,111 @@ def convert_type(tiff_type):
     return nb_bytes
 
 
-def read_image_header(fid, start_position):
+# An entry of an image file directory (IFD) : tag, type, count and value.
+# The value holds the values themselves when they fit in 4 bytes, otherwise
+# the position where they are stored.
+IFD_ENTRY = numpy.dtype([('tag', '<u2'), ('type', '<u2'),
+                         ('count', '<u4'), ('value', '<u4')])
+
+TIFF_DTYPE = {1: '<u1', 3: '<u2', 4: '<u4'}
+
+# Values stored outside of the IFD that are closer than this are read at once.
+MAX_BATCH_READ = 65536
+
+
+def read_tag_values(fid, entries):
+    '''
+    Returns a dictionary giving the tuple of values of each IFD entry, by
+    tag. The values stored outside of the IFD are read in a single read when
+    they are close to each other.
     '''
-    Read the image header
+    values = dict()
+    outside = list()
+    for tag, tiff_type, count, value in entries.tolist():
+        nb_bytes = convert_type(tiff_type) * count
+        if nb_bytes > 4:  # This is an offset
+            outside.append((value, nb_bytes, tag, tiff_type, count))
+        else:
+            values[tag] = tuple(numpy.frombuffer(pack('<I', value),
+                                                 TIFF_DTYPE[tiff_type],
+                                                 count).tolist())
+    if not outside:
+        return values
+    start = min(position for position, nb_bytes, _, _, _ in outside)
+    end = max(position + nb_bytes for position, nb_bytes, _, _, _ in outside)
+    if end - start <= MAX_BATCH_READ:
+        fid.seek(start)
+        block = fid.read(end - start)
+        for position, nb_bytes, tag, tiff_type, count in outside:
+            values[tag] = tuple(numpy.frombuffer(block, TIFF_DTYPE[tiff_type],
+                                                 count,
+                                                 position - start).tolist())
+    else:
+        for position, nb_bytes, tag, tiff_type, count in outside:
+            fid.seek(position)
+            values[tag] = tuple(numpy.frombuffer(fid.read(nb_bytes),
+                                                 TIFF_DTYPE[tiff_type],
+                                                 count).tolist())
+    return values
+
+
+def read_image_header(fid, start_position, read_cz_info=True):
+    '''
+    Read the image header. If read_cz_info is False, only the offset of the
+    CZ LSM info is kept.
+
+    The whole entry table is read at once, together with the offset of the
+    next header which is stored in 'Next Header Offset'.
     '''
     header = dict()
     # Default values.
     header['Tiff Sample Format'] = 1
     header['Predictor'] = 1
+    header['Compression'] = 1
     fid.seek(start_position)
     nb_tag = unpack('=H', fid.read(2))[0]
-    for i in range(nb_tag):
-        current_tag_position = start_position + 2 + i * 12
-        tag = read_tag(fid, current_tag_position)
-        if tag[0] == 254:
-            header['New Subfile Type'] = tag[4]
-        elif tag[0] == 256:
-            header['Width'] = tag[4]
-        elif tag[0] == 257:
-            header['Length'] = tag[4]
-        elif tag[0] == 258:
-            nb_bytes = convert_type(tag[1])
-            if nb_bytes * tag[2] > 4:  # This is an offset
-                new_tag = read_tag(fid, tag[4])
-                header['Bit / Sample'] = new_tag[1]
-            else:
-                header['Bit / Sample'] = tag[4]
-        elif tag[0] == 259:
-            header['Compression'] = tag[4]
-        elif tag[0] == 262:
-            header['Photometric Interpretation'] = tag[4]
-        elif tag[0] == 273:
-            nb_bytes = convert_type(tag[1])
-            if nb_bytes * tag[2] > 4:  # This is an offset
-                new_tag = read_tag(fid, tag[4], 'Long')
-                header['Strip Offset'] = new_tag[0]
-            else:
-                new_tag = read_tag(fid, current_tag_position, 'Long')
-                header['Strip Offset'] = new_tag[2]
-            header['Strip Number'] = tag[2]
-        elif tag[0] == 277:
-            header['Sample / Pixel'] = tag[4]
-        elif tag[0] == 279:
-            new_tag = read_tag(fid, current_tag_position, 'Long')
-            nb_bytes = convert_type(tag[1])
-            header['Strip Byte Counts'] = new_tag[2]
-            if nb_bytes * tag[2] > 4:  # This is an offset
-                new_tag = read_tag(fid, tag[4], 'Long')
-                header['Strip Byte Counts'] = new_tag[0]
-            else:
-                header['Strip Byte Counts'] = new_tag[2]
-        elif tag[0] == 317:
-            header['Predictor'] = tag[4]
-        elif tag[0] == 320:
-            header['Colormap'] = tag[4]
-        elif tag[0] == 339:
-            header['Tiff Sample Format'] = tag[4]
-        elif tag[0] == 34412:
-            header['CZ LSM info offset'] = tag[4]
-            new_tag = read_tag(fid, header['CZ LSM info offset'], 'LSMInfo')
-            header['CZ LSM info'] = new_tag
+    block = fid.read(nb_tag * 12 + 4)
+    entries = numpy.frombuffer(block, IFD_ENTRY, nb_tag)
+    header['Next Header Offset'] = unpack('<I', block[nb_tag * 12:])[0]
+    # Only these tags have several values.
+    values = read_tag_values(fid, entries[numpy.isin(entries['tag'],
+                                                     (258, 273, 279))])
+    for tag, tiff_type, count, value in entries.tolist():
+        if tiff_type == 3 and count == 1:
+            value = value & 0xFFFF
+        if tag == 254:
+            header['New Subfile Type'] = value
+        elif tag == 256:
+            header['Width'] = value
+        elif tag == 257:
+            header['Length'] = value
+        elif tag == 258:
+            header['Bit / Sample'] = values[tag][0]
+        elif tag == 259:
+            header['Compression'] = value
+        elif tag == 262:
+            header['Photometric Interpretation'] = value
+        elif tag == 273:
+            header['Strip Offset List'] = values[tag]
+            header['Strip Offset'] = values[tag][0]
+            header['Strip Number'] = count
+        elif tag == 277:
+            header['Sample / Pixel'] = value
+        elif tag == 279:
+            header['Strip Byte Count List'] = values[tag]
+            header['Strip Byte Counts'] = values[tag][0]
+        elif tag == 317:
+            header['Predictor'] = value
+        elif tag == 320:
+            header['Colormap'] = value
+        elif tag == 339:
+            header['Tiff Sample Format'] = value
+        elif tag == 34412:
+            header['CZ LSM info offset'] = value
+            if read_cz_info:
+                new_tag = read_tag(fid, header['CZ LSM info offset'],
+                                   'LSMInfo')
+                header['CZ LSM info'] = new_tag
     if 'CZ LSM info' in header:
         header['Image Size X'] = (header['Width'] *
                                   header['CZ LSM info']['Voxel Size X'] *
@@ -154,20 +199,119 @@ def read_image_header(fid, start_position):
     return header
 
 
-def read_stack(fid, width, length, bits_per_samples, compression):
+def build_index(headers):
     '''
-    Reads one stack of the image file
+    Returns the index of the strips of the images : for each (stack, channel)
+    the offset, the byte count, the compression and the predictor.
+    '''
+    index = dict()
+    for stack, this_header in enumerate(headers):
+        for channel in range(this_header['Sample / Pixel']):
+            index[(stack, channel)] = (
+                                this_header['Strip Offset List'][channel],
+                                this_header['Strip Byte Count List'][channel],
+                                this_header['Compression'],
+                                this_header['Predictor'])
+    return index
+
+
+def read_stack(fid, width, length, bits_per_samples, compression,
+               byte_count=None, out=None):
+    '''
+    Reads one stack of the image file. byte_count is the size of the strip
+    in the file, which differs from the size of the stack when compressed.
+    If out is given, the stack is read directly in it.
     '''
     if bits_per_samples == 8:
-        s = fid.read(length * width)
         order = 'B'
     elif bits_per_samples == 16:
-        s = fid.read(length * width * 2)
         order = 'H'
+    elif bits_per_samples == 32:
+        order = 'I'
+    else:
+        raise ValueError("only 8, 16 and 32 bits samples are supported, "
+                         "not %s" % bits_per_samples)
+    size = length * width * numpy.dtype(order).itemsize
+    if out is None:
+        out = numpy.empty(length * width, order)
+    # out is not initialised: a strip shorter than the stack must not leave
+    # part of it unread.
     if compression == 5:
-        s = lzw.decodelzw(s)
-    data = numpy.fromstring(s, order)
-    return data
+        if byte_count is None:
+            byte_count = size
+        nb_bytes = lzw.decodelzw_into(fid.read(byte_count), out)
+    else:
+        nb_bytes = fid.readinto(memoryview(out).cast('B'))
+    if nb_bytes != size:
+        raise ValueError("strip too short")
+    return out
+
+
+def undo_predictor(plane):
+    '''
+    Undoes in place the horizontal differencing (TIFF predictor 2) of a
+    plane whose rows are the lines of the image.
+    '''
+    if plane.dtype.itemsize not in (1, 2, 4):
+        raise ValueError("predictor 2 is only supported for 8, 16 and 32 "
+                         "bits samples")
+    numpy.add.accumulate(plane, axis=1, out=plane)
+    return plane
+
+
+def read_plane(filename, offset, byte_count, width, length, bits_per_samples,
+               compression, predictor):
+    '''
+    Reads the plane stored in the strip at offset and returns it as a matrix.
+    The file is opened here so that planes can be read in worker processes.
+    '''
+    with open(filename, 'rb') as fid:
+        return read_strip(fid, offset, byte_count, width, length,
+                          bits_per_samples, compression, predictor)
+
+
+# Channels of the parent process decoded in by the worker processes, set by
+# share_channels.
+_shared_channels = None
+
+
+def share_channels(channels):
+    '''
+    Initializer of the worker processes decoding in the channels of the
+    parent process, when their memory is shared with it (anonymous memory
+    maps inherited by fork).
+    '''
+    global _shared_channels
+    _shared_channels = channels
+
+
+def read_plane_shared(filename, offset, byte_count, width, length,
+                      bits_per_samples, compression, predictor, channel,
+                      start):
+    '''
+    Reads the plane stored in the strip at offset directly in the shared
+    channel, from its element start, in a worker process: nothing is sent
+    back to the parent process.
+    '''
+    out = _shared_channels[channel][start:start + width * length]
+    with open(filename, 'rb') as fid:
+        read_strip(fid, offset, byte_count, width, length, bits_per_samples,
+                   compression, predictor, out)
+
+
+def read_strip(fid, offset, byte_count, width, length, bits_per_samples,
+               compression, predictor, out=None):
+    '''
+    Reads the plane stored in the strip at offset, undoes its predictor and
+    returns it as a matrix. If out is given, the plane is read in it.
+    '''
+    fid.seek(offset)
+    plane = read_stack(fid, width, length, bits_per_samples, compression,
+                       byte_count, out)
+    plane = plane.reshape((width, length))
+    if predictor == 2:
+        undo_predictor(plane)
+    return plane
 
 
 def read_image(fid, headers, cz_info):
@@ -17,10 +17,42 @@ If you have several stacks :
 
 >>> imageData = imageFile.get_image(stack=10,channel=0)
 
+If you only need a few planes of a big file, open it lazily. Uncompressed
+files are then memory mapped and compressed planes are only decoded when
+requested :
+
+>>> imageFile.open(lazy=True)
+
+Compressed files are faster to open when their planes are decoded by several
+processes :
+
+>>> imageFile.open(workers=8)
+
+To go through a file too big for the memory, plane by plane :
+
+>>> for stack, channel, plane in imageFile.iter_planes(reuse=True):
+...     process(plane)
+
+Files opened again and again can be decoded once and kept on disk (see the
+lsmcache module) :
+
+>>> imageFile.open(cache=lsmcache.Diskcache(CACHE_FOLDER))
+
+To only get the metadata (dimensions, voxel sizes...) without reading any
+pixel :
+
+>>> header = imageFile.read_header()
+>>> voxelSize = header['CZ LSM info']['Voxel Size X']
+
 To get the histogram of the image :
 
 >>> [x, y] = imageFile.get_hist()
 
+To find the rotation that gives the sharpest projection of the image :
+
+>>> angle, projections = imageFile.find_rotation(threshold=1000, workers=4)
+>>> imageFile.set_rotation(angle)
+
 To avoid all the pixels that have a value below than 1000 (for example).
 
 >>> imageThresh = imageFile.get_threshold(1000)
@@ -28,13 +60,21 @@ To avoid all the pixels that have a value below than 1000 (for example).
 This command will produce the same matrix as the one from get_image, but with a
 mask that prevent pixels below the threshold to be considered.
 '''
+import mmap
+import multiprocessing
 import pdb
+from collections import OrderedDict
+from concurrent import futures
+from itertools import repeat
 from struct import unpack
 
 import numpy
-from scipy import misc, ndimage
+from scipy import ndimage
 
 import lsmparse
+import normalize
+import rotation
+import spectrum
 
 __author__  = "Charles Roduit <charles.roduit@gmail.com>"
 __date__ = "25 juillet 2008"
@@ -54,6 +94,9 @@ class Lsmimage:
     
     # def __new__(cls):
     #     pass
+
+    # Memory used by the rotated planes kept by get_image.
+    max_rotated_bytes = 256 * 2 ** 20
         
     def __init__(self, filename, time=None):
         self.image = dict()
@@ -66,6 +109,8 @@ class Lsmimage:
         self.counter = 0 # will vary between 0 and 100 to show the evolution of
                          # internal state
         self.header = {'Image':[], 'Thumbnail':[], 'CZ LSM info':[]}
+        self.index = dict()
+        self.rotated_bytes = 0
         
     def __cmp__(self, other):
         '''
@@ -73,89 +118,187 @@ class Lsmimage:
         '''
         return cmp(self.time, other.time)
         
-    def open(self):
+    def open(self, lazy=False, workers=None, cache=None):
+        '''
+        Load the image in the memory. The compressed planes are decoded in
+        a pool of workers processes if workers is greater than 1.
+
+        With lazy set to True, the pixels are only read when a plane is
+        requested : uncompressed files are memory mapped and each channel is
+        a view on the file, compressed planes are decoded the first time
+        they are accessed.
+
+        cache is an optional lsmcache.Diskcache. If it holds the file, the
+        decoded planes are memory mapped from it, otherwise the decoded
+        image is stored in it (unless opened lazily). Opened eagerly, the
+        channels are still whole volumes in memory, read from the cache
+        instead of decoded; opened lazily, the planes are served from the
+        memory mapped chunks.
+        '''
+        self.read_header()
+        self.image.pop('stacks', None)
+        self.image.pop('chunks', None)
+        self.__clear_rotated()
+        if not self.header['Image']:
+            return
+        if cache is not None:
+            key = cache.key(self.filename, self.index)
+            chunks = cache.load(key)
+            if chunks is not None:
+                if lazy:
+                    self.image['planes'] = dict()
+                    self.image['chunks'] = chunks
+                else:
+                    # A channel is one volume, as when decoded: its chunks
+                    # are copied into it.
+                    self.image['data'] = [
+                        numpy.concatenate(channel_chunks).transpose(1, 2, 0)
+                        if len(channel_chunks) > 1 else
+                        channel_chunks[0].transpose(1, 2, 0)
+                        for channel_chunks in chunks]
+                return
+        if lazy:
+            self.image['planes'] = dict()
+            data = self.__map_image(self.header['Image'],
+                                    self.header['CZ LSM info'])
+            if data is not None:
+                self.image['data'] = data
+            return
+        # We send all headers corresponding to the images, we don't care
+        # about thmubnails.
+        with open(self.filename, 'rb') as fid:
+            self.image['data'] = self.__read_image(fid,
+                                                    self.header['Image'],
+                                                    self.header['CZ LSM info'],
+                                                    workers)
+        self.nbstack = self.image['data'][0].shape[2]
+        if cache is not None:
+            cache.store(key, self.image['data'])
+
+    def read_header(self):
         '''
-        Load the image in the memory
+        Reads the headers of the file without reading any pixel.
+
+        self.header is filled as by open, and self.index gives for each
+        (stack, channel) the offset and the byte count of its strip, its
+        compression and its predictor.
         '''
-        __fid = open(self.filename, 'rb')
-        # The first part of the file gives basic informations
-        # most important ar im_id, which has to be 42, and im_offset which
-        # informs on the position of the first image header.
-        [byte_order, im_id, im_offset] = unpack('3H', __fid.read(6))
-        byte_order = hex(byte_order) # Only Intel Byte order are supported
-        if im_id == 42:
+        self.header = {'Image':[], 'Thumbnail':[], 'CZ LSM info':[]}
+        self.index = dict()
+        with open(self.filename, 'rb') as fid:
+            # The first part of the file gives basic informations
+            # most important ar im_id, which has to be 42, and im_offset which
+            # informs on the position of the first image header.
+            [byte_order, im_id, im_offset] = unpack('=2HI', fid.read(8))
+            byte_order = hex(byte_order) # Only Intel Byte order are supported
+            if im_id != 42:
+                return self.header
             # There is as much headers as stacks. We scan all the headers. At
-            # the end of each header, there is the iformation on the position 
+            # the end of each header, there is the iformation on the position
             # of the next header, that we store in im_offset. The last header
             # has an im_offset = 0.
             # Each header is important as they contain the information of the
-            # position of the corresponding image (offset).
+            # position of the corresponding image (offset). The CZ LSM info
+            # is only parsed the first time it is found.
             while im_offset:
-                tmp_header = lsmparse.read_image_header(__fid, im_offset)
+                tmp_header = lsmparse.read_image_header(
+                                    fid, im_offset,
+                                    not self.header['CZ LSM info'])
                 if tmp_header['New Subfile Type']:
                     self.header['Thumbnail'].append(tmp_header)
                 else:
                     self.header['Image'].append(tmp_header)
                 if 'CZ LSM info' in tmp_header:
                     self.header['CZ LSM info'] = tmp_header['CZ LSM info']
-                im_offset = unpack('H', __fid.read(2))[0]
-            # We send all headers corresponding to the images, we don't care
-            # about thmubnails.
-            self.image['data'] = self.__read_image(__fid,
-                                                    self.header['Image'],
-                                                    self.header['CZ LSM info'])
-            self.nbstack = self.image['data'][0].shape[2]
-            
+                im_offset = tmp_header['Next Header Offset']
+        self.index = lsmparse.build_index(self.header['Image'])
+        self.nbstack = len(self.header['Image'])
+        return self.header
+
+    def iter_planes(self, channel=None, reuse=False):
+        '''
+        Iterates over the planes of the file and yields (stack, channel,
+        plane) without keeping them in memory. If channel is given, only
+        the planes of this channel are read.
+
+        With reuse set to True, all the planes are read in the same buffer :
+        a plane is then only valid until the next one is yielded.
+        '''
+        if not self.index:
+            self.read_header()
+        buffers = dict()
+        with open(self.filename, 'rb') as fid:
+            for stack, this_header in enumerate(self.header['Image']):
+                if channel is None:
+                    channels = range(this_header['Sample / Pixel'])
+                else:
+                    channels = [channel]
+                for this_channel in channels:
+                    [offset, byte_count, compression, predictor] = \
+                                          self.index[(stack, this_channel)]
+                    out = None
+                    if reuse:
+                        ntyp = numpy.dtype('uint%d' %
+                                           this_header['Bit / Sample'])
+                        size = this_header['Width'] * this_header['Length']
+                        if (size, ntyp) not in buffers:
+                            buffers[(size, ntyp)] = numpy.empty(size, ntyp)
+                        out = buffers[(size, ntyp)]
+                    plane = lsmparse.read_strip(fid, offset, byte_count,
+                                                this_header['Width'],
+                                                this_header['Length'],
+                                                this_header['Bit / Sample'],
+                                                compression, predictor, out)
+                    yield stack, this_channel, plane
+
     def add_stack(self, matrix_list, where='top'):
         '''
-        Adds a stack to the image data
-        '''
-        new_matrix_list = list()
-        for channel_nbr in range(len(self.image['data'])):
-            image_shape = list(self.image['data'][channel_nbr].shape)
-            image_shape[2] = image_shape[2]+1
-            new_image = numpy.zeros(image_shape)
-            if where == 'top':
-                new_image[:, :, :image_shape[2]-1] = \
-                                      self.image['data'][channel_nbr]
-                new_image[:, :, image_shape[2]-1] = matrix_list[channel_nbr]
-            elif where == 'bottom':
-                new_image[:, :, 1:] = self.image['data'][channel_nbr]
-                new_image[:, :, 0] = matrix_list[channel_nbr]
-            new_matrix_list.append(new_image)
-        self.image['data'] = new_matrix_list
+        Adds a stack to the image data. matrix_list gives the new plane of
+        each channel, added at the 'top' (last stack) or at the 'bottom'
+        (first stack). The planes keep the type of the image.
+        '''
+        self.__load_data()
+        if 'stacks' not in self.image:
+            self.image['stacks'] = [Stackbuffer(volume)
+                                    for volume in self.image['data']]
+        for channel_nbr, stack in enumerate(self.image['stacks']):
+            stack.append(matrix_list[channel_nbr], where)
+        self.image['data'] = [stack.data for stack in self.image['stacks']]
         self.nbstack += 1
+        # Adding at the bottom numbers the stacks again, so the rotated
+        # planes kept by stack number no longer match; adding on top leaves
+        # the existing stacks as they are.
+        if where == 'bottom':
+            self.__clear_rotated()
         
     def close(self):
         '''
         Close the image by cleaning the memory. The image can still be opened
         using the open method
         '''
-        del(self.image['data'])
+        self.image.pop('data', None)
+        self.image.pop('planes', None)
+        self.image.pop('map', None)
+        self.image.pop('stacks', None)
+        self.image.pop('chunks', None)
         del(self.header)
-        if 'rotated' in self.image:
-            del(self.image['rotated'])
+        self.__clear_rotated()
             
     def threshold(self, value):
         '''
         Computes the threshold of all the images
         '''
+        self.__load_data()
         self.image['Threshold'] = list()
         for image in self.image['data']:
             self.image['Threshold'].append(image > value)
             
-    def __fft(self, input_image):
+    def __fft(self, input_image, dtype=numpy.float64):
         '''
         Computes the fast Fourrier transform of the image sent in argument        
         The method returns the module and the phase image.
         '''
-        fft_image = numpy.fft.fftpack.fft2(input_image)
-        tmp_module_image = numpy.sqrt(fft_image.real ** 2 + fft_image.imag ** 2)
-        tmp_phase_image = numpy.arctan2(fft_image.real, fft_image.imag)
-        # reorder the images...
-        module_image = numpy.fft.fftshift(tmp_module_image)
-        phase_image = numpy.fft.fftshift(tmp_phase_image)
-        return [module_image, phase_image]
+        return spectrum.Fftengine(dtype).transform(input_image)
         
     def get_blob(self):
         '''
@@ -181,29 +324,50 @@ class Lsmimage:
             value = 1.2
             
         original_image = self.get_image()
-        vector = original_image.copy()
-        vector = numpy.reshape(vector, vector.size)
-        vector.sort()
-        return vector[numpy.ceil(len(vector) / value)]
+        # Read from the histogram of the pixel values instead of sorting them.
+        return normalize.rank_value(original_image,
+                                    int(numpy.ceil(original_image.size /
+                                                   value)))
         
-    def get_fft(self, stack=-1, channel=-1, precision=1):
+    def get_fft(self, stack=-1, channel=-1, precision=1,
+                dtype=numpy.float64):
         '''
         Computes the fast Fourrier transform of the image. You can specify the
         stack and the channel you want to compute. If stack and channel are not
         specified, it computes the fft on the latest displayed image.
+        dtype can be numpy.float32 to compute it faster in simple precision.
         
         The method returns the module and the phase image.
         '''
         initial_image = self.get_image(stack, channel, precision, angle = 0)
-        [module_image, phase_image] = self.__fft(initial_image)
+        [module_image, phase_image] = self.__fft(initial_image, dtype)
         module_image = self.__rotate_image(module_image, precision = precision)
         phase_image = self.__rotate_image(phase_image, precision = precision)
         return [module_image, phase_image]
+
+    def get_fft_stack(self, channel=-1, precision=1, dtype=numpy.float64,
+                      workers=None):
+        '''
+        Computes the fast Fourrier transform of all the stacks of a channel,
+        in a pool of workers threads if workers is greater than 1.
+
+        The method returns the list of the module and phase images of each
+        stack, as get_fft.
+        '''
+        if channel + 1:
+            self.channel = channel
+        images = [self.get_image(stack, self.channel, precision, angle=0)
+                  for stack in range(self.nbstack)]
+        spectra = spectrum.Fftengine(dtype).transform_stack(images, workers)
+        return [[self.__rotate_image(module_image, precision=precision),
+                 self.__rotate_image(phase_image, precision=precision)]
+                for module_image, phase_image in spectra]
         
     def get_hist(self, stack=0, length=100):
         '''
         Returns the histogram of the image pixel values
         '''
+        self.__load_data()
         vect_y, vect_x = numpy.histogram(self.image['data'][stack], length)
         return vect_x, vect_y
         
@@ -218,12 +382,120 @@ class Lsmimage:
         if channel + 1:
             self.channel = channel
         if angle or (precision != 1):
-            return self.__rotate_image(self.image['data']
-                                                [self.channel]
-                                                [:, :, self.stack],
-                                      angle, precision)
+            return self.__get_rotated(self.stack, self.channel, angle,
+                                      precision)
         else:
-            return (self.image['data'][self.channel][:, :, self.stack])
+            return self.__get_plane(self.stack, self.channel)
+
+    def __get_rotated(self, stack, channel, angle, precision):
+        '''
+        Returns one plane rotated and resized. The last planes rotated are
+        kept in image['rotated'] (up to max_rotated_bytes), by stack,
+        channel, angle and precision. They are read only.
+        '''
+        rotated = self.image.setdefault('rotated', OrderedDict())
+        key = (stack, channel, angle, precision)
+        if key in rotated:
+            rotated.move_to_end(key)
+            return rotated[key]
+        matrix = self.__rotate_image(self.__get_plane(stack, channel), angle,
+                                     precision)
+        matrix.data.flags.writeable = False
+        matrix.mask.flags.writeable = False
+        rotated[key] = matrix
+        self.rotated_bytes += matrix.data.nbytes + matrix.mask.nbytes
+        while self.rotated_bytes > self.max_rotated_bytes and len(rotated) > 1:
+            _, old = rotated.popitem(last=False)
+            self.rotated_bytes -= old.data.nbytes + old.mask.nbytes
+        return matrix
+
+    def __clear_rotated(self):
+        '''
+        Forgets the rotated planes, when the planes change.
+        '''
+        self.image.pop('rotated', None)
+        self.rotated_bytes = 0
+
+    def __get_plane(self, stack, channel):
+        '''
+        Returns one plane of one channel. When the image was opened lazily,
+        the plane is read the first time it is requested.
+        '''
+        if 'data' in self.image:
+            return self.image['data'][channel][:, :, stack]
+        if (stack, channel) not in self.image['planes']:
+            self.image['planes'][(stack, channel)] = \
+                                      self.__read_plane(stack, channel)
+        return self.image['planes'][(stack, channel)]
+
+    def __read_plane(self, stack, channel):
+        '''
+        Reads one plane of one channel from the file.
+        '''
+        this_header = self.header['Image'][stack]
+        shape = (this_header['Width'], this_header['Length'])
+        ntyp = numpy.dtype('uint%d' % this_header['Bit / Sample'])
+        [offset, byte_count, compression, predictor] = \
+                                          self.index[(stack, channel)]
+        if 'chunks' in self.image:
+            chunks = self.image['chunks'][channel]
+            chunk_size = len(chunks[0])
+            return chunks[stack // chunk_size][stack % chunk_size]
+        if 'map' in self.image:
+            size = shape[0] * shape[1] * ntyp.itemsize
+            return self.image['map'][offset:offset + size].view(ntyp).reshape(
+                                                                        shape)
+        return lsmparse.read_plane(self.filename, offset, byte_count,
+                                   this_header['Width'],
+                                   this_header['Length'],
+                                   this_header['Bit / Sample'],
+                                   compression, predictor)
+
+    def __map_image(self, headers, cz_info):
+        '''
+        Memory maps the uncompressed images. Returns one array per channel,
+        viewing the planes directly in the file, or None if the planes have
+        to be read one by one.
+        '''
+        if cz_info['Scan Type'] != 0:
+            return None
+        for this_header in headers:
+            if (this_header['Compression'] != 1 or
+                this_header['Predictor'] != 1 or
+                this_header['Tiff Sample Format'] != 1):
+                return None
+        self.image['map'] = numpy.memmap(self.filename, numpy.uint8, 'r')
+        ntyp = numpy.dtype('uint%d' % headers[0]['Bit / Sample'])
+        width = headers[0]['Width']
+        length = headers[0]['Length']
+        data = list()
+        for channel in range(headers[0]['Sample / Pixel']):
+            offsets = [this_header['Strip Offset List'][channel]
+                       for this_header in headers]
+            # A channel is a single view only if its planes are equally
+            # spaced in the file, otherwise they are mapped one by one.
+            step = offsets[1] - offsets[0] if len(offsets) > 1 else 0
+            if step < 0 or numpy.any(numpy.diff(offsets) != step):
+                return None
+            data.append(numpy.ndarray((width, length, len(headers)), ntyp,
+                                      buffer=self.image['map'],
+                                      offset=offsets[0],
+                                      strides=(length * ntyp.itemsize,
+                                               ntyp.itemsize, step)))
+        return data
+
+    def __load_data(self):
+        '''
+        Reads all the planes that were not read yet when the image was
+        opened lazily.
+        '''
+        if 'data' in self.image:
+            return
+        data = list()
+        for channel in range(self.header['Image'][0]['Sample / Pixel']):
+            data.append(numpy.dstack([self.__get_plane(stack, channel)
+                                      for stack in range(self.nbstack)]))
+        self.image['data'] = data
             
     def __rotate_image(self, matrix, angle=None, precision=1):
         '''
@@ -237,25 +509,29 @@ class Lsmimage:
         '''
         if angle == None:
             angle = self.angle
-        # The rotation is done by converting the matrix in a PIL object
-        # and then applying the rotation to it to finally reconvert
-        # into a numpy matrix.
+        # The matrix is resized and rotated in a single affine transform.
         #
         # A mask is generated to reject pixels that are outside the
         # original image. It finally results in a masked array. Thanks
         # to that, we can do matrix manipulation without taking care
         # of suplementary pixels generated by the rotation.
-        
-        tmp_image = misc.toimage(matrix, mode = 'F')
-        new_size = (numpy.array(tmp_image.size) * precision).round()
-        tmp_image = tmp_image.resize(new_size)
-        tmp_mask = misc.toimage(numpy.ones(new_size).transpose(),
-                                mode = 'F')
-        array_image = misc.fromimage(tmp_image.rotate(angle, expand = 1))
-        array_mask = abs(misc.fromimage(tmp_mask.rotate(angle,
-                                                        expand = 1))
-                        -1)
-        return numpy.ma.array(array_image, mask=array_mask)
+        return rotation.rotate(matrix, angle, precision)
+
+    def get_rotated_stack(self, channel=-1, precision=1, angle=None):
+        '''
+        Returns all the stacks of a channel, resized and rotated in a single
+        call, as a masked array of shape (width, length, stacks).
+        '''
+        if angle is None:
+            angle = self.angle
+        if channel + 1:
+            self.channel = channel
+        if 'data' in self.image:
+            volume = self.image['data'][self.channel]
+        else:
+            volume = numpy.dstack([self.__get_plane(stack, self.channel)
+                                   for stack in range(self.nbstack)])
+        return rotation.rotate_stack(volume, angle, precision)
             
     def get_projection(self, precision=1, threshold=None):
         '''
@@ -266,6 +542,135 @@ class Lsmimage:
         else:
             matrix = self.get_image(precision = precision)
         return matrix.sum(0)
+
+    def get_projections(self, angles, precision=1, threshold=None,
+                        workers=None):
+        '''
+        Returns an approximation of the projections in the x axis of the
+        image rotated at each angle, as get_projection gives them, without
+        rotating the image : each pixel of the image is shared between the
+        columns its rotated square covers, in proportion to the area over
+        each of them, as in a Radon transform, instead of resampling the
+        rotated image. The projections are smoother than those of the
+        nearest neighbour interpolation of get_projection: on a 512 x 512
+        image, they differ from them by about 1 % of their maximum, up to
+        10 % with precision=0.25. The pixels lower or equal to threshold are
+        left out, as in get_threshold. With workers greater than 1, the angles are computed
+        by a pool of threads.
+        '''
+        return [profile for profile, count in
+                self.__sweep(angles, precision, threshold, workers)]
+
+    def find_rotation(self, angles=None, precision=1, threshold=None,
+                      coarse_precision=0.25, refine_step=0.1, workers=None,
+                      sharpness=None):
+        '''
+        Searches the rotation giving the sharpest projection in the x axis.
+        All the angles (by default -90 to 89 degrees, by 1 degree) are first
+        tried on the image resized by coarse_precision, then the angles
+        around the best one, by refine_step, on the image resized by
+        precision. threshold and workers are used as in get_projections.
+
+        The sharpness of a projection is by default the variance of the mean
+        of the columns (weighted by their number of pixels), so that the
+        shape of the rotated image does not count. Another measure can be
+        given as a function of the projection.
+
+        The method returns the best angle and a dictionary giving the
+        projection of each refined angle.
+        '''
+        if sharpness is None:
+            def score(profile, count):
+                mean = profile.sum() / count.sum()
+                inside = count > 0
+                return (((profile[inside] / count[inside] - mean) ** 2 *
+                         count[inside]).sum() / count.sum())
+        else:
+            def score(profile, count):
+                return sharpness(profile)
+        if angles is None:
+            angles = numpy.arange(-90, 90)
+        angles = numpy.asarray(angles, numpy.float64)
+        sweep = self.__sweep(angles, coarse_precision, threshold, workers)
+        best = numpy.argmax([score(*result) for result in sweep])
+        # The refined angles go up to the neighbours of the best one.
+        step = numpy.diff(numpy.sort(angles)).max() if len(angles) > 1 else 0
+        fine_angles = numpy.arange(angles[best] - step,
+                                   angles[best] + step + refine_step / 2,
+                                   refine_step).round(10)
+        sweep = self.__sweep(fine_angles, precision, threshold, workers)
+        best = numpy.argmax([score(*result) for result in sweep])
+        return fine_angles[best], {angle: profile for angle, (profile, count)
+                                   in zip(fine_angles.tolist(), sweep)}
+
+    def __sweep(self, angles, precision, threshold, workers):
+        '''
+        Returns, for each angle, the projection of the current image rotated
+        by this angle and the number of pixels of the image in each column,
+        both counting the parts of the pixels shared between columns.
+        '''
+        matrix = numpy.asarray(self.get_image(precision=precision, angle=0),
+                               numpy.float64)
+        rows, cols = numpy.indices(matrix.shape).reshape(2, -1)
+        weights = matrix.reshape(-1).copy()
+        if threshold != None:
+            weights[weights <= threshold] = 0
+        # Position of the center of the pixels, from the center of the image
+        rows = rows + 0.5 - matrix.shape[0] / 2
+        cols = cols + 0.5 - matrix.shape[1] / 2
+
+        def project(angle):
+            length = rotation.geometry(matrix.shape, angle)[2][1]
+            radians = numpy.radians(angle)
+            sin, cos = abs(numpy.sin(radians)), abs(numpy.cos(radians))
+            # Each pixel is shared between the columns its rotated square
+            # covers, in proportion to the area over each of them: dropped
+            # in a single column, the pixels fall one or two per column at
+            # 45 degrees and the projection becomes a comb. The projection
+            # of the square on the x axis is the convolution of two boxes
+            # of widths small and large; inside(t) is the part of it before
+            # t, from the start of the footprint.
+            small, large = max(min(sin, cos), 1e-9), max(sin, cos)
+
+            def inside(t):
+                t = numpy.clip(t, 0, small + large)
+                return numpy.where(
+                    t < small, t * t / (2 * small * large),
+                    numpy.where(t < large, (2 * t - small) / (2 * large),
+                                1 - (small + large - t) ** 2 /
+                                (2 * small * large)))
+
+            # Start of the footprint, in 1 / 256 of a pixel from 2 pixels
+            # before the first column, as the footprints overhanging the
+            # image are counted in its first or last column.
+            start = ((numpy.sin(radians) * rows + numpy.cos(radians) * cols +
+                      length / 2 - (small + large) / 2 + 2) * 256)
+            start = numpy.rint(start, out=start).astype(numpy.intp)
+            # The shares only depend on where the footprint starts in its
+            # first column, read from a table. The footprint is at most
+            # sqrt(2) wide: 3 columns.
+            offset = start & 255
+            first = start >> 8
+            offsets = numpy.arange(256) / 256
+            size = max(first.max() + 3, length + 2)
+            profile = numpy.zeros(size)
+            count = numpy.zeros(size)
+            for column in range(3):
+                shares = (inside(column + 1 - offsets) -
+                          inside(column - offsets))[offset]
+                profile[column:column + size - 2] += numpy.bincount(
+                            first, shares * weights, minlength=size - 2)
+                count[column:column + size - 2] += numpy.bincount(
+                            first, shares, minlength=size - 2)
+            for values in (profile, count):
+                values[2] += values[:2].sum()
+                values[length + 1] += values[length + 2:].sum()
+            return profile[2:length + 2], count[2:length + 2]
+
+        if workers is None or workers == 1:
+            return [project(angle) for angle in angles]
+        with futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(project, angles))
         
     def get_rotation(self):
         '''
@@ -292,49 +697,142 @@ class Lsmimage:
         '''
         self.angle = angle
     
-    def __read_image(self, fid, headers, cz_info):     
+    def __read_image(self, fid, headers, cz_info, workers=None):
         '''
-        Read the images and return them as matrices
+        Read the images and return them as matrices. With workers > 1, the
+        compressed planes are decoded in a pool of as many processes, which
+        write them directly in the channels: the channels are then anonymous
+        memory maps, shared with the workers by fork. Uncompressed planes,
+        or systems without fork, are read in this process.
         '''
         self.counter = 0
         totalImages = 0
         currentImage = 0
         for this_header in headers:
             totalImages = totalImages + this_header['Sample / Pixel']
+        # Uncompressed planes are only copied from the file: a pool would
+        # only add its overhead.
+        compressed = any(entry[2] != 1 for entry in self.index.values())
+        parallel = (workers is not None and workers > 1 and compressed and
+                    'fork' in multiprocessing.get_all_start_methods())
         if cz_info['Scan Type'] == 0:
             if headers[0]['Tiff Sample Format'] == 1:
                 data = list()
-                ntyp = eval("numpy.dtype(numpy.uint%d)" % headers[0]['Bit / Sample'])
+                ntyp = numpy.dtype('uint%d' % headers[0]['Bit / Sample'])
                 for channel in range(headers[0]['Sample / Pixel']):
-                    data.append(numpy.empty((headers[0]['Width'] *
-                                             headers[0]['Length'] *
-                         len(headers)),ntyp))
+                    size = (headers[0]['Width'] * headers[0]['Length'] *
+                            len(headers))
+                    if parallel:
+                        data.append(numpy.frombuffer(
+                                mmap.mmap(-1, size * ntyp.itemsize), ntyp))
+                    else:
+                        data.append(numpy.empty(size, ntyp))
                 z_image = 0
                 size_image = this_header['Width'] * this_header['Length']
-                for this_header in headers:
-                    offset = this_header['Strip Offset']
-                    fid.seek(offset)
-                    for channel in range(this_header['Sample / Pixel']):
-                        this_stack = lsmparse.read_stack(fid,
-                                               this_header['Width'],
-                                               this_header['Length'],
-                                               this_header['Bit / Sample'],
-                                               this_header['Compression'])
-                        data[channel][size_image * z_image : size_image * (z_image + 1)] = this_stack
-                        currentImage += 1
-                        self.counter = currentImage / float(totalImages)
-                    z_image += 1
+                if parallel:
+                    # The workers undo the predictor of their planes too.
+                    keys = sorted(self.index)
+                    with futures.ProcessPoolExecutor(
+                            workers,
+                            mp_context=multiprocessing.get_context('fork'),
+                            initializer=lsmparse.share_channels,
+                            initargs=(data,)) as executor:
+                        planes = executor.map(
+                            lsmparse.read_plane_shared,
+                            repeat(self.filename),
+                            [self.index[key][0] for key in keys],
+                            [self.index[key][1] for key in keys],
+                            [headers[key[0]]['Width'] for key in keys],
+                            [headers[key[0]]['Length'] for key in keys],
+                            [headers[key[0]]['Bit / Sample'] for key in keys],
+                            [self.index[key][2] for key in keys],
+                            [self.index[key][3] for key in keys],
+                            [key[1] for key in keys],
+                            [size_image * key[0] for key in keys],
+                            chunksize=max(1, len(keys) // (4 * workers)))
+                        for _ in planes:
+                            currentImage += 1
+                            self.counter = currentImage / float(totalImages)
+                else:
+                    for this_header in headers:
+                        for channel in range(this_header['Sample / Pixel']):
+                            # The strip is decoded directly in the channel
+                            # and its predictor is undone right away.
+                            lsmparse.read_strip(fid,
+                                    this_header['Strip Offset List'][channel],
+                                    this_header['Strip Byte Count List'][channel],
+                                                this_header['Width'],
+                                                this_header['Length'],
+                                                this_header['Bit / Sample'],
+                                                this_header['Compression'],
+                                                this_header['Predictor'],
+                                                data[channel][size_image * z_image : size_image * (z_image + 1)])
+                            currentImage += 1
+                            self.counter = currentImage / float(totalImages)
+                        z_image += 1
             for channel in range(this_header['Sample / Pixel']):
                 data[channel].shape = (len(headers), this_header['Width'], this_header['Length'])
-                if headers[0]['Predictor'] == 2:
-                    if headers[0]['Bit / Sample'] == 8:
-                        dtype = 'B'
-                    elif headers[0]['Bit / Sample'] == 16:
-                        dtype = 'H'
-                    numpy.cumsum(data[channel], axis=2, dtype=dtype, out=data[channel])
                 data[channel] = data[channel].transpose(1,2,0)
             return data
 
+class Stackbuffer:
+    '''
+    Volume whose planes are stored along the third axis and to which planes
+    can be added on both sides. The memory is over allocated on both sides,
+    so that adding a plane costs a constant time on average instead of
+    copying the whole volume.
+
+    self.data is the view on the planes currently stored.
+    '''
+
+    def __init__(self, volume):
+        volume = numpy.asarray(volume)
+        nbstack = volume.shape[2]
+        capacity = max(2 * nbstack, 4)
+        self.__start = (capacity - nbstack) // 2
+        self.__end = self.__start + nbstack
+        self.__buffer = numpy.empty(volume.shape[:2] + (capacity,),
+                                    volume.dtype)
+        self.__buffer[:, :, self.__start:self.__end] = volume
+        self.data = self.__buffer[:, :, self.__start:self.__end]
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def append(self, matrix, where='top'):
+        '''
+        Adds a plane after the last one ('top') or before the first one
+        ('bottom').
+        '''
+        if where == 'top':
+            if self.__end == self.__buffer.shape[2]:
+                self.__grow()
+            self.__buffer[:, :, self.__end] = matrix
+            self.__end += 1
+        elif where == 'bottom':
+            if self.__start == 0:
+                self.__grow()
+            self.__start -= 1
+            self.__buffer[:, :, self.__start] = matrix
+        else:
+            raise ValueError("where must be 'top' or 'bottom'")
+        self.data = self.__buffer[:, :, self.__start:self.__end]
+
+    def __grow(self):
+        '''
+        Doubles the capacity, keeping the planes in the middle of the buffer.
+        '''
+        nbstack = len(self)
+        capacity = max(2 * self.__buffer.shape[2], 4)
+        start = (capacity - nbstack) // 2
+        new_buffer = numpy.empty(self.__buffer.shape[:2] + (capacity,),
+                                 self.__buffer.dtype)
+        new_buffer[:, :, start:start + nbstack] = self.data
+        self.__buffer = new_buffer
+        self.__start = start
+        self.__end = start + nbstack
+
+
 if __name__ == '__main__':
     # import doctest
     LSM_FILE = '../../Example_file/INRIA.lsm'
@@ -37,6 +37,9 @@ import struct
 
 import numpy
 
+# Number of bytes of a strip whose codes are extracted at once.
+WINDOW_BLOCK = 4096
+
 def decodelzw(encoded):
     """Decompress LZW (Lempel-Ziv-Welch) encoded TIFF strip (byte string).
 
@@ -54,7 +57,7 @@ def decodelzw(encoded):
         try:
             code = unpack('>I', s)[0]
         except Exception:
-            code = unpack('>I', s + '\x00'*(4-len(s)))[0]
+            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
         code = code << (bitcount % 8)
         code = code & mask
         return code >> shr
@@ -81,7 +84,7 @@ def decodelzw(encoded):
         if code == 257: # EOI
             break
         if code == 256: # CLEAR
-            table = [chr(i) for i in range(256)]
+            table = [bytes((i,)) for i in range(256)]
             table.extend((0, 0))
             lentable = 258
             bitw, shr, mask = switchbitch[255]
@@ -93,10 +96,10 @@ def decodelzw(encoded):
         else:
             if code < lentable:
                 decoded = table[code]
-                newcode = table[oldcode] + decoded[0]
+                newcode = table[oldcode] + decoded[:1]
             else:
                 newcode = table[oldcode]
-                newcode += newcode[0]
+                newcode += newcode[:1]
                 decoded = newcode
             result.append(decoded)
             table.append(newcode)
@@ -107,14 +110,166 @@ def decodelzw(encoded):
 
     if code != 257:
         raise ValueError("unexpected end of stream")
-    return ''.join(result)
+    return b''.join(result)
+
+
+def decodelzw_into(encoded, out):
+    """Decompress LZW encoded TIFF strip into a preallocated buffer.
+
+    encoded : bytes, bytearray or memoryview
+        The compressed strip. It must begin with a CLEAR code and end with
+        an EOI code.
+
+    out : writable buffer
+        Destination of the decoded bytes (bytearray, numpy array, ...).
+        Its size is usually known from the image header.
+
+    Returns the number of bytes written to `out`.
+
+    Every string of the code table is a substring of what has already been
+    decoded, so the table only stores the offset and the length of the last
+    occurence of each code in `out` instead of growing Python strings.
+    `decodelzw` is kept as the reference implementation.
+
+    """
+    data = numpy.frombuffer(encoded, numpy.uint8)
+    nbits = len(data) * 8
+    if len(data) < 4:
+        raise ValueError("strip must be at least 4 characters long")
+    # A code is at most 12 bits wide and starts at most 7 bits in its first
+    # byte, so the 3 bytes starting at its first byte always contain it.
+    # These 24 bit windows are computed by blocks of WINDOW_BLOCK bytes, so
+    # that only one block of Python ints is alive at a time.
+    def windows(start):
+        block = numpy.zeros(min(WINDOW_BLOCK, len(data) - start) + 2,
+                            numpy.uint32)
+        chunk = data[start:start + len(block)]
+        block[:len(chunk)] = chunk
+        window = block[:-2] << 16
+        window |= block[1:-1] << 8
+        window |= block[2:]
+        return window.tolist(), start, start + len(window)
+
+    window, base, limit = windows(0)
+    out = memoryview(out).cast('B')
+    outsize = len(out)
+
+    offsets = [0] * 4096
+    lengths = [0] * 4096
+    bitw = 9
+    bitmask = 511
+    bitcount = 0
+    pos = 0
+    if window[0] >> 15 != 256:
+        raise ValueError("strip must begin with CLEAR code")
+
+    while 1:
+        if bitcount + bitw > nbits:
+            raise ValueError("unexpected end of stream")
+        byte = bitcount >> 3
+        if byte >= limit:
+            window, base, limit = windows(byte)
+        code = (window[byte - base] >>
+                (24 - bitw - (bitcount & 7))) & bitmask
+        bitcount += bitw
+        if code == 257: # EOI
+            break
+        if code == 256: # CLEAR
+            lentable = 258
+            bitw = 9
+            bitmask = 511
+            if bitcount + bitw > nbits:
+                raise ValueError("unexpected end of stream")
+            byte = bitcount >> 3
+            if byte >= limit:
+                window, base, limit = windows(byte)
+            code = (window[byte - base] >>
+                    (24 - bitw - (bitcount & 7))) & bitmask
+            bitcount += bitw
+            if code == 257: # EOI
+                break
+            if code > 255:
+                raise ValueError("invalid code after CLEAR")
+            if pos >= outsize:
+                raise ValueError("output buffer too small")
+            out[pos] = code
+            oldpos = pos
+            oldlen = 1
+            pos += 1
+            continue
+        if code < 256:
+            if pos >= outsize:
+                raise ValueError("output buffer too small")
+            out[pos] = code
+            length = 1
+        elif code < lentable:
+            start = offsets[code]
+            length = lengths[code]
+            if pos + length > outsize:
+                raise ValueError("output buffer too small")
+            out[pos:pos+length] = out[start:start+length]
+        elif code == lentable:
+            # The code is being defined: previous string + its first byte.
+            length = oldlen + 1
+            if pos + length > outsize:
+                raise ValueError("output buffer too small")
+            out[pos:pos+oldlen] = out[oldpos:oldpos+oldlen]
+            out[pos+oldlen] = out[oldpos]
+        else:
+            raise ValueError("invalid code %d" % code)
+        # The new entry is the previous string followed by the first byte
+        # of the current one, which is exactly what lies in `out` there.
+        if lentable < 4096:
+            offsets[lentable] = oldpos
+            lengths[lentable] = oldlen + 1
+            lentable += 1
+            if lentable == 511:
+                bitw, bitmask = 10, 1023
+            elif lentable == 1023:
+                bitw, bitmask = 11, 2047
+            elif lentable == 2047:
+                bitw, bitmask = 12, 4095
+        oldpos = pos
+        oldlen = length
+        pos += length
+
+    return pos
+
+
+def decodelzw_buffer(encoded, size=None):
+    """Decompress LZW encoded TIFF strip and return a bytearray.
+
+    encoded : bytes, bytearray or memoryview
+
+    size : int
+        Expected size of the decoded strip, e.g. width * length * bytes per
+        sample. If not given, the buffer is grown until the strip fits.
+
+    """
+    if size is not None:
+        out = bytearray(size)
+        del out[decodelzw_into(encoded, out):]
+        return out
+    size = max(len(encoded) * 4, 4096)
+    while 1:
+        out = bytearray(size)
+        try:
+            nbytes = decodelzw_into(encoded, out)
+        except ValueError as err:
+            if str(err) != "output buffer too small":
+                raise
+            size *= 2
+        else:
+            del out[nbytes:]
+            return out
 
 
 
 def unpackints(data, dtype, intsize, runlen=0):
     """Decompress byte string to array of integers of any bit size <= 32.
 
-    data : str
+    data : bytes, bytearray or memoryview
+        The integers are packed most significant bit first, as in TIFF.
 
     dtype : numpy.dtype or str
         A numpy boolean or integer type.
@@ -125,10 +280,13 @@ def unpackints(data, dtype, intsize, runlen=0):
     runlen : int
         Number of consecutive integers, after which to start at next byte
 
+    The bit offset of every integer is computed at once, and each integer is
+    extracted from the bytes it spans with whole array shifts and masks.
+
     """
     # bitarray
     if intsize == 1:
-        data = numpy.fromstring(data, '|B')
+        data = numpy.frombuffer(data, '|B')
         data = numpy.unpackbits(data)
         if runlen % 8 != 0:
             data = data.reshape(-1, runlen+(8-runlen%8))
@@ -137,7 +295,7 @@ def unpackints(data, dtype, intsize, runlen=0):
 
     dtype = numpy.dtype(dtype)
 
-    if 32 < intsize < 1:
+    if not 1 <= intsize <= 32:
         raise ValueError("intsize out of range")
 
     if dtype.kind not in "biu":
@@ -146,40 +304,30 @@ def unpackints(data, dtype, intsize, runlen=0):
     if intsize > dtype.itemsize * 8:
         raise ValueError("dtype.itemsize too small")
 
-    for i in (8, 16, 32):
-        if intsize <= i:
-            itembytes = i // 8
-            break
-
+    data = numpy.frombuffer(data, numpy.uint8)
+    nbits = len(data) * 8
     if runlen == 0:
-        runlen = len(data) // itembytes
-    skipbits = runlen*intsize % 8
-    if skipbits:
-        skipbits = 8 - skipbits
-    shrbits = itembytes*8 - intsize
-    bitmask = int(intsize*'1'+'0'*shrbits, 2)
-    if dtype.byteorder == '|':
-        dtypestr = '=' + dtype.char
+        # No padding: all the integers that fit in data.
+        bitpos = numpy.arange(nbits // intsize, dtype=numpy.int64) * intsize
     else:
-        dtypestr = dtype.byteorder + dtype.char
-    unpack = struct.unpack
-
-    l = runlen * (len(data)*8 // (runlen*intsize + skipbits))
-    result = numpy.empty((l,), dtype)
-
-    bitcount = 0
-    for i in range(len(result)):
-        start = bitcount // 8
-        s = data[start:start+itembytes]
-        try:
-            code = unpack(dtypestr, s)[0]
-        except Exception:
-            code = unpack(dtypestr, s + '\x00'*(itembytes-len(s)))[0]
-        code = code << (bitcount % 8)
-        code = code & bitmask
-        result[i] = code >> shrbits
-        bitcount += intsize
-        if (i+1) % runlen == 0:
-            bitcount += skipbits
+        # Each run of integers is padded to the next byte.
+        runbits = runlen * intsize
+        runbits += -runbits % 8
+        bitpos = (numpy.arange(nbits // runbits, dtype=numpy.int64)[:, None]
+                  * runbits +
+                  numpy.arange(runlen, dtype=numpy.int64) * intsize).ravel()
 
-    return result
+    # An integer starts at most 7 bits in its first byte, so it spans at most
+    # nbytes bytes which are gathered in a big endian 64 bits integer.
+    nbytes = (intsize + 7 + 7) // 8
+    start = bitpos >> 3
+    padded = numpy.zeros(len(data) + nbytes, numpy.uint8)
+    padded[:len(data)] = data
+    code = numpy.zeros(len(bitpos), numpy.uint64)
+    for i in range(nbytes):
+        code <<= numpy.uint64(8)
+        code |= padded[start + i]
+    code >>= (numpy.uint64(nbytes * 8 - intsize) -
+              (bitpos & 7).astype(numpy.uint64))
+    code &= numpy.uint64((1 << intsize) - 1)
+    return code.astype(dtype)
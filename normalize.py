@@ -0,0 +1,112 @@
+'''
+normalize scales images into the range 0 to 256 from a percentile of their
+pixel values instead of their maximum, so that a few hot pixels do not
+darken the whole image :
+
+>>> image_data = normalize(raw_image_data, q=99.9)
+
+The percentiles of 8 and 16 bits images are read from the histogram of their
+values (np.bincount), computed in one pass without sorting the pixels. The
+histogram of a whole stack can be accumulated plane by plane :
+
+>>> counts = None
+>>> for stack, channel, plane in imageFile.iter_planes(0, reuse=True):
+...     counts = histogram(plane, counts)
+>>> top = histogram_percentile(counts, 99.9)
+'''
+import numpy as np
+
+# Number of pixels counted at once: np.bincount converts them to intp.
+CHUNK_SIZE = 2 ** 20
+
+
+def histogram(data, counts=None):
+    """
+    Counts the pixel values of an 8 or 16 bits image
+    :param data: array of uint8 or uint16
+    :param counts: histogram to add the counts to, e.g. of the previous
+        planes of a stack
+    :return: array of the number of pixels of each value
+    """
+    if data.dtype not in (np.uint8, np.uint16):
+        raise ValueError('histograms are only computed for 8 and 16 bits '
+                         'images')
+    if counts is None:
+        counts = np.zeros(2 ** (8 * data.dtype.itemsize), np.int64)
+    data = data.reshape(-1)
+    for start in range(0, data.size, CHUNK_SIZE):
+        counts += np.bincount(data[start:start + CHUNK_SIZE],
+                              minlength=len(counts))
+    return counts
+
+
+def histogram_rank(counts, rank):
+    """
+    Returns the value of rank rank (from 0) of the sorted pixels
+    """
+    return int(np.searchsorted(np.cumsum(counts), rank, side='right'))
+
+
+def histogram_percentile(counts, q):
+    """
+    Returns the percentile q of the pixels counted in the histogram, with the
+    linear interpolation of np.percentile
+    """
+    position = q / 100 * (counts.sum() - 1)
+    cumulated = np.cumsum(counts)
+    low, high = np.searchsorted(cumulated,
+                                [np.floor(position), np.ceil(position)],
+                                side='right')
+    return low + (high - low) * (position - np.floor(position))
+
+
+def rank_value(data, rank):
+    """
+    Returns the value of rank rank (from 0) of the sorted pixels of data,
+    without sorting them. The masked pixels of a masked array are ranked
+    last, as np.ma sorts them: np.ma.masked is returned for their ranks.
+    """
+    if isinstance(data, np.ma.MaskedArray):
+        data = data.compressed()
+        if rank >= data.size:
+            return np.ma.masked
+    if data.dtype in (np.uint8, np.uint16):
+        return data.dtype.type(histogram_rank(histogram(data), rank))
+    return np.partition(data.reshape(-1), rank)[rank]
+
+
+def percentile(data, q):
+    """
+    Returns the percentile q of the pixel values of data, from their
+    histogram for 8 and 16 bits images
+    """
+    if q == 100:
+        return data.max()
+    if data.dtype in (np.uint8, np.uint16):
+        return histogram_percentile(histogram(data), q)
+    return np.percentile(data, q)
+
+
+def normalize(data, q=100, maximum=256, dtype=np.float64, out=None,
+              top=None):
+    """
+    Scales the pixel values so that the percentile q becomes maximum
+    :param data: image
+    :param q: percentile, the pixel values above it are clipped to maximum.
+        With 100, the image is scaled by its maximum
+    :param maximum: value of the percentile once scaled
+    :param dtype: type of the scaled image
+    :param out: array receiving the scaled image, which can be data itself
+        if it has the type dtype
+    :param top: value scaled to maximum, e.g. the percentile of a whole
+        stack. Computed from data if None
+    :return: scaled image
+    """
+    if top is None:
+        top = percentile(data, q)
+    if out is None:
+        out = np.empty(data.shape, dtype)
+    np.multiply(data, maximum / top, out=out, casting='unsafe')
+    if q < 100:
+        np.minimum(out, maximum, out=out)
+    return out
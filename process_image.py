@@ -1,5 +1,7 @@
 import utilities as util
 from read_lsm import read_lsm_image
+from vessels import measure_vessels
+from normalize import normalize
 from matplotlib import pyplot as plt
 import numpy as np
 from skimage import measure, exposure
@@ -18,7 +20,7 @@ raw_image_data_red = read_lsm_image(folder_name, image_name, stack=0, channel=0)
 # raw_image_data_green = read_lsm_image(folder_name, image_name, stack=0, channel=1)
 
 # Put pixel values into the range 0 to 256
-image_data = (raw_image_data_red / np.max(raw_image_data_red)) * 256
+image_data = normalize(raw_image_data_red)
 # image_data_green = (raw_image_data_green / np.max(raw_image_data_green)) * 256
 
 # image_data = image_data_red
@@ -57,17 +59,10 @@ area = 25
 sigma = 3
 mask = 26
 
-image_adjusted = image_data * (image_data >= mask)
+metrics = measure_vessels(image_data, sigma=sigma, mask=mask, min_area=area)
+qualified_segments = metrics.segments
 
-edges0 = skimage.feature.canny(image=image_adjusted, sigma=sigma)
-segs0 = measure.regionprops(measure.label(edges0))
-qualified_segments = []
-all_coords = np.zeros([1, 2])
-for seg in segs0:
-    if seg.filled_area > area:
-        qualified_segments.append(seg)
-
-print(f'Average vessel width: {np.mean([seg.minor_axis_length for seg in qualified_segments])}')
+print(f'Average vessel width: {metrics.average_width}')
 
 # areas = [s.convex_area for s in qualified_segments]
 # plt.figure()
@@ -1,28 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+
 import lsmreader
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
-from skimage import measure, exposure
-import skimage.feature
-import skimage.viewer
 import cv2
 
 
-def read_lsm_image(folder, filename, **kwargs):
+class PlaneCache:
+    """
+    Process wide cache of the planes read by read_lsm_image. When the planes
+    take more than max_bytes, the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._planes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the plane stored under key, or None
+        """
+        with self._lock:
+            plane = self._planes.get(key)
+            if plane is not None:
+                self._planes.move_to_end(key)
+            return plane
+
+    def put(self, key, plane):
+        """
+        Stores a plane, then drops the oldest planes until the cache fits in
+        max_bytes. Planes bigger than max_bytes are not stored.
+        """
+        if plane.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._planes:
+                self.nbytes -= self._planes.pop(key).nbytes
+            self._planes[key] = plane
+            self.nbytes += plane.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._planes.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._planes.clear()
+            self.nbytes = 0
+
+
+plane_cache = PlaneCache()
+
+
+def file_extension(filename):
+    """
+    Returns the extension of a file name in lower case, e.g. '.lsm' for
+    'image.LSM'
+    """
+    return os.path.splitext(filename)[1].lower()
+
+
+def read_lsm_image(folder, filename, cache=True, **kwargs):
     """
     Reads an image of .lsm file type
     :param folder: name of the folder
     :param filename: name of file in the folder directory
+    :param cache: keep the planes in plane_cache, so that reading the same
+        plane again does not decode the file. Only the stack and channel
+        kwargs can be used with the cache. The cached planes are read only.
     :param kwargs: specify kwargs to pass to the get_image() function
     :return: image file as a numpy array
     """
 
-    if filename[-4:] == '.lsm':
-        image_file = lsmreader.Lsmimage(f'{folder}//{filename}')
-        image_file.open()
-        return image_file.get_image(**kwargs)
+    if file_extension(filename) == '.lsm':
+        path = f'{folder}//{filename}'
+        key = None
+        if cache and set(kwargs) <= {'stack', 'channel'}:
+            # A new Lsmimage shows the first stack of the first channel.
+            stack = kwargs.get('stack', -1)
+            channel = kwargs.get('channel', -1)
+            status = os.stat(path)
+            key = (os.path.abspath(path), status.st_mtime_ns, status.st_size,
+                   stack if stack != -1 else 0,
+                   channel if channel != -1 else 0)
+            plane = plane_cache.get(key)
+            if plane is not None:
+                return plane
+        image_file = lsmreader.Lsmimage(path)
+        image_file.open(lazy=True)
+        plane = image_file.get_image(**kwargs)
+        if key is not None:
+            # Copied so that the cache does not keep the file mapped.
+            plane = np.array(plane)
+            plane.flags.writeable = False
+            plane_cache.put(key, plane)
+        return plane
 
-    elif filename[-4:] == '.jpg':
+    elif file_extension(filename) == '.jpg':
         return cv2.imread(f'{folder}//{filename}', 0)
 
 
@@ -0,0 +1,142 @@
+'''
+regions computes the statistics of all the regions of a label image at once,
+with np.bincount over the pixels of the regions, instead of one
+skimage.measure.regionprops object per region :
+
+>>> stats = Regionstats(measure.label(edges))
+>>> kept = stats.select(min_area=25)
+>>> widths = stats.minor_axis_length[kept]
+
+The arrays of statistics are indexed by label, the index 0 being the
+background. The filled area, which needs the image of the region, is only
+computed for the regions whose area alone does not tell if they are kept,
+and the regionprops objects of the selected regions only when they are read.
+'''
+from collections.abc import Sequence
+
+import numpy as np
+from scipy import ndimage
+from skimage import measure
+
+# 8-connectivity, as regionprops fills the holes of the regions.
+FILL_STRUCTURE = np.ones((3, 3), bool)
+
+
+class Regionstats:
+    '''
+    Area, bounding box, centroid and ellipse axes of all the labels of a 2D
+    label image whose labels are 1 to N, as measure.label gives them.
+    '''
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.slices = ndimage.find_objects(labels)
+        count = len(self.slices) + 1
+        rows, cols = np.nonzero(labels)
+        pixel_labels = labels[rows, cols]
+
+        self.area = np.bincount(pixel_labels, minlength=count)
+        # The background and the missing labels have no pixels.
+        pixels = np.maximum(self.area, 1)
+        self.centroid_row = (np.bincount(pixel_labels, rows, count) /
+                             pixels)
+        self.centroid_col = (np.bincount(pixel_labels, cols, count) /
+                             pixels)
+
+        # Second central moments, from the distances to the centroids to
+        # avoid the loss of precision of sum(x ** 2) - sum(x) ** 2 / n.
+        rows = rows - self.centroid_row[pixel_labels]
+        cols = cols - self.centroid_col[pixel_labels]
+        var_row = np.bincount(pixel_labels, rows * rows, count) / pixels
+        var_col = np.bincount(pixel_labels, cols * cols, count) / pixels
+        covar = np.bincount(pixel_labels, rows * cols, count) / pixels
+
+        # Eigenvalues of the inertia tensor, as regionprops.
+        half_trace = (var_row + var_col) / 2
+        delta = np.sqrt(((var_row - var_col) / 2) ** 2 + covar ** 2)
+        self.major_axis_length = 4 * np.sqrt(half_trace + delta)
+        self.minor_axis_length = 4 * np.sqrt(np.maximum(half_trace - delta,
+                                                        0))
+
+        self.bbox_area = np.zeros(count, np.int64)
+        for label, slices in enumerate(self.slices, 1):
+            if slices is not None:
+                self.bbox_area[label] = ((slices[0].stop - slices[0].start) *
+                                         (slices[1].stop - slices[1].start))
+        self._filled_area = dict()
+        self._props = None
+
+    def filled_area(self, label):
+        '''
+        Returns the area of the region with its holes filled, as regionprops
+        '''
+        if label not in self._filled_area:
+            image = self.labels[self.slices[label - 1]] == label
+            self._filled_area[label] = int(np.count_nonzero(
+                        ndimage.binary_fill_holes(image, FILL_STRUCTURE)))
+        return self._filled_area[label]
+
+    def select(self, min_area):
+        '''
+        Returns the labels of the regions whose filled area is above
+        min_area. The filled area lies between the area and the area of the
+        bounding box, so it is only computed when min_area is in between.
+        '''
+        kept = self.area > min_area
+        uncertain = np.flatnonzero(~kept & (self.bbox_area > min_area))
+        for label in uncertain:
+            kept[label] = self.filled_area(label) > min_area
+        kept[0] = False
+        return np.flatnonzero(kept)
+
+    def regionprops(self, selected):
+        '''
+        Returns the skimage region properties of the selected labels, as a
+        Regionlist: the objects are only created when the list is read.
+        '''
+        return Regionlist(self, selected)
+
+    def _region_objects(self, selected):
+        # Only the objects of the selected labels are created, from the
+        # label image where the other labels are erased. The last ones are
+        # kept for the same selection.
+        key = np.asarray(selected).tobytes()
+        if self._props is None or self._props[0] != key:
+            lookup = np.zeros(len(self.area), self.labels.dtype)
+            lookup[selected] = selected
+            self._props = (key, measure.regionprops(lookup[self.labels]))
+        return self._props[1]
+
+    def mask(self, selected):
+        '''
+        Returns the boolean image of the pixels of the selected labels,
+        built in one step with a lookup table
+        '''
+        lookup = np.zeros(len(self.area), bool)
+        lookup[selected] = True
+        return lookup[self.labels]
+
+
+class Regionlist(Sequence):
+    '''
+    Read only list of the skimage region properties of the selected labels
+    of a Regionstats. Its length is known at once, the objects are created
+    the first time an item is read, so that the callers reading only the
+    statistics do not pay for them.
+    '''
+
+    def __init__(self, stats, selected):
+        self._stats = stats
+        self._selected = selected
+        self._objects = None
+
+    def __len__(self):
+        return len(self._selected)
+
+    def __getitem__(self, index):
+        if self._objects is None:
+            self._objects = self._stats._region_objects(self._selected)
+        return self._objects[index]
+
+    def __repr__(self):
+        return 'Regionlist(%d regions)' % len(self)
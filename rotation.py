@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+rotation rotates and resizes the planes of an image with
+scipy.ndimage.affine_transform, as Lsmimage.get_image(angle=...) shows them.
+
+>>> rotated = rotate(imageData, 30, precision=0.5)
+>>> rotated_stack = rotate_stack(volume, 30)
+
+The matrix is resized by precision, then rotated counterclockwise by angle
+degrees around its center, the result being enlarged to hold the whole
+rotated matrix (as PIL rotate with expand). The resizing and the rotation
+are done in a single interpolation. The pixels that do not come from the
+matrix are masked : the mask is computed from the rotated bounding box of
+the matrix, row by row, instead of rotating a matrix of ones.
+'''
+import math
+
+import numpy
+from scipy import ndimage
+
+
+def geometry(shape, angle, precision=1):
+    '''
+    Returns the matrix and the offset giving, for the indices of a pixel of
+    the rotated matrix, the indices of the pixel of the original matrix, the
+    shape of the rotated matrix and the shape of the resized matrix.
+    '''
+    rows, cols = shape
+    new_rows, new_cols = numpy.round(numpy.array(shape) * precision)
+    angle = math.radians(angle)
+    # Rounded, so that multiples of 90 degrees are exact.
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    # Size of the bounding box of the rotated corners, as PIL computes it.
+    half_rows = (abs(cos) * new_rows + abs(sin) * new_cols) / 2
+    half_cols = (abs(sin) * new_rows + abs(cos) * new_cols) / 2
+    if cos == 0 or sin == 0:
+        # Multiples of 90 degrees only transpose or flip the matrix; the
+        # bounding box above is one pixel too large when its sides are
+        # centred between pixels and not the sides of the matrix.
+        out_shape = ((int(new_rows), int(new_cols)) if sin == 0 else
+                     (int(new_cols), int(new_rows)))
+    else:
+        out_shape = (math.ceil(new_rows / 2 + half_rows) -
+                     math.floor(new_rows / 2 - half_rows),
+                     math.ceil(new_cols / 2 + half_cols) -
+                     math.floor(new_cols / 2 - half_cols))
+    # From the position in the rotated matrix, relative to its center, to
+    # the position in the resized matrix, relative to its center.
+    rotation = numpy.array([[cos, sin], [-sin, cos]])
+    scale = numpy.diag([rows / new_rows, cols / new_cols])
+    out_center = numpy.array(out_shape) / 2
+    center = numpy.array([new_rows, new_cols]) / 2
+    # The pixels are centred on the indices + 0.5.
+    matrix = scale @ rotation
+    offset = scale @ (rotation @ (0.5 - out_center) + center) - 0.5
+    return matrix, offset, out_shape, (new_rows, new_cols)
+
+
+def valid_mask(shape, angle, precision=1):
+    '''
+    Returns the mask of the rotated matrix, True for the pixels that do not
+    come from the matrix.
+    '''
+    _, _, out_shape, (new_rows, new_cols) = geometry(shape, angle, precision)
+    angle = math.radians(angle)
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    out_rows = numpy.arange(out_shape[0]) + 0.5 - out_shape[0] / 2
+    first_col = 0.5 - out_shape[1] / 2
+    start = numpy.zeros(out_shape[0])
+    stop = numpy.full(out_shape[0], float(out_shape[1]))
+    # Along a row of the rotated matrix, each coordinate in the resized
+    # matrix is base + step * column, and must lie in [0, size).
+    for base, step, size in (
+            (cos * out_rows + sin * first_col + new_rows / 2, sin, new_rows),
+            (-sin * out_rows + cos * first_col + new_cols / 2, cos, new_cols)):
+        if step > 0:
+            start = numpy.maximum(start, numpy.ceil(-base / step))
+            stop = numpy.minimum(stop, numpy.ceil((size - base) / step))
+        elif step < 0:
+            start = numpy.maximum(start,
+                                  numpy.floor((size - base) / step) + 1)
+            stop = numpy.minimum(stop, numpy.floor(-base / step) + 1)
+        else:
+            outside = (base < 0) | (base >= size)
+            stop[outside] = 0
+    columns = numpy.arange(out_shape[1])
+    return ((columns < start[:, numpy.newaxis]) |
+            (columns >= stop[:, numpy.newaxis]))
+
+
+def rotate(matrix, angle, precision=1, order=0, dtype=numpy.float32):
+    '''
+    Returns the matrix resized by precision and rotated by angle degrees, as
+    a masked array of type dtype. order is the order of the spline
+    interpolation, 0 (nearest pixel) as PIL does by default.
+    '''
+    transform, offset, out_shape, _ = geometry(matrix.shape, angle,
+                                               precision)
+    array_image = ndimage.affine_transform(numpy.asarray(matrix, dtype),
+                                           transform, offset, out_shape,
+                                           output=dtype, order=order,
+                                           mode='nearest')
+    return numpy.ma.array(array_image,
+                          mask=valid_mask(matrix.shape, angle, precision))
+
+
+def rotate_stack(volume, angle, precision=1, order=0, dtype=numpy.float32):
+    '''
+    Rotates all the planes of a volume of shape (width, length, planes) in
+    a single call, see rotate.
+    '''
+    transform, offset, out_shape, _ = geometry(volume.shape[:2], angle,
+                                               precision)
+    # The planes are neither moved nor mixed.
+    transform3 = numpy.eye(3)
+    transform3[:2, :2] = transform
+    array_image = ndimage.affine_transform(numpy.asarray(volume, dtype),
+                                           transform3,
+                                           numpy.append(offset, 0),
+                                           out_shape + volume.shape[2:],
+                                           output=dtype, order=order,
+                                           mode='nearest')
+    mask = valid_mask(volume.shape[:2], angle, precision)
+    return numpy.ma.array(array_image,
+                          mask=numpy.repeat(mask[:, :, numpy.newaxis],
+                                            volume.shape[2], axis=2))
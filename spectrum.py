@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+spectrum computes the module and the phase of the Fourier transform of real
+images, shifted so that the null frequency is at the center, as
+Lsmimage.get_fft returns them.
+
+>>> engine = Fftengine(numpy.float32, workers=4)
+>>> [module_image, phase_image] = engine.transform(imageData)
+>>> spectra = engine.transform_stack(planes)
+
+The transform of a real image is symmetric, so only half of it is computed
+(scipy.fft.rfft2) and the other half is read from its conjugate. scipy.fft
+keeps the plans of the shapes already transformed; the positions of the
+shifted spectrum in the half transform are kept here, per shape.
+'''
+import functools
+from concurrent import futures
+
+import numpy
+from scipy import fft
+
+
+@functools.lru_cache(maxsize=32)
+def shift_index(shape):
+    '''
+    Returns, for each pixel of the shifted spectrum of an image of the given
+    shape, the position of its value in the half transform given by rfft2
+    and whether it is the conjugate of this value.
+    '''
+    rows, cols = shape
+    half = cols // 2 + 1
+    # fftshift puts the frequency (i - n // 2) % n at the position i.
+    row_freq = ((numpy.arange(rows) - rows // 2) % rows)[:, None]
+    col_freq = ((numpy.arange(cols) - cols // 2) % cols)[None, :]
+    direct = col_freq < half
+    index = numpy.where(direct,
+                        row_freq * half + col_freq,
+                        (-row_freq % rows) * half + (-col_freq % cols))
+    conjugate = numpy.broadcast_to(~direct, shape).copy()
+    index.flags.writeable = False
+    conjugate.flags.writeable = False
+    return index, conjugate
+
+
+class Fftengine:
+    '''
+    Computes the spectra of real images in dtype (numpy.float64 or
+    numpy.float32) precision. workers is the number of threads of each
+    transform.
+    '''
+
+    def __init__(self, dtype=numpy.float64, workers=None):
+        self.dtype = numpy.dtype(dtype)
+        self.workers = workers
+
+    def transform(self, image):
+        '''
+        Returns the shifted module and phase of the Fourier transform of the
+        image.
+        '''
+        image = numpy.asarray(image, self.dtype)
+        half = fft.rfft2(image, workers=self.workers)
+        index, conjugate = shift_index(image.shape)
+        module_image = numpy.abs(half).take(index)
+        real = half.real.take(index)
+        imag = half.imag.take(index)
+        numpy.negative(imag, out=imag, where=conjugate)
+        phase_image = numpy.arctan2(real, imag)
+        return [module_image, phase_image]
+
+    def transform_stack(self, images, workers=None):
+        '''
+        Returns the spectra of several images, computed by a pool of workers
+        threads (scipy.fft releases the GIL while transforming). Without
+        workers, they are computed one after the other.
+        '''
+        if workers is None or workers == 1:
+            return [self.transform(image) for image in images]
+        with futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(self.transform, images))
@@ -0,0 +1,130 @@
+'''
+tiled runs the canny edge detection of vessels on overlapping tiles, so that
+the floating point temporaries of the detection are the size of a tile
+instead of the size of the image. The result is the same as on the whole
+image :
+
+>>> labels = label_edges(image_data, sigma=3, mask=26, tile=1024)
+
+The overlap of the tiles is the reach of the detection around a pixel: the
+radius of the gaussian filter, the sobel filter and the non maximum
+suppression. Only the hysteresis (keeping the weak edges connected to a
+strong edge) reaches further; it is done once the tiles are stitched, by
+merging the weak edges of the tiles that touch across a seam.
+'''
+from concurrent import futures
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import skimage.feature
+from skimage.util import dtype_limits
+
+# Thresholds of skimage.feature.canny, relative to the largest value of the
+# type of the image.
+LOW_THRESHOLD = 0.1
+HIGH_THRESHOLD = 0.2
+
+# 8-connectivity, as measure.label and the hysteresis of canny
+STRUCTURE = np.ones((3, 3), bool)
+
+
+def overlap(sigma):
+    '''
+    Returns the number of pixels around a tile that change the edges of the
+    tile, before the hysteresis.
+    '''
+    # Gaussian filter of radius int(4 * sigma + 0.5), sobel filter, non
+    # maximum suppression and the eroded border of canny.
+    return int(4 * sigma + 0.5) + 3
+
+
+def tiles(shape, tile, margin):
+    '''
+    Yields, for each tile, the slices of the tile and of the tile with its
+    margin in the image.
+    '''
+    for row in range(0, shape[0], tile):
+        for col in range(0, shape[1], tile):
+            core = (slice(row, min(row + tile, shape[0])),
+                    slice(col, min(col + tile, shape[1])))
+            padded = (slice(max(row - margin, 0),
+                            min(row + tile + margin, shape[0])),
+                      slice(max(col - margin, 0),
+                            min(col + tile + margin, shape[1])))
+            yield core, padded
+
+
+def _tile_edges(image, sigma, mask, core, padded):
+    # Weak edges (above the low threshold) of the tile, labelled, and
+    # whether each of them holds a strong edge (above the high threshold).
+    data = image[padded]
+    data = data * (data >= mask)
+    scale = dtype_limits(data, clip_negative=False)[1]
+    crop = tuple(slice(c.start - p.start, c.stop - p.start)
+                 for c, p in zip(core, padded))
+    # With equal thresholds, canny keeps the local maxima above them.
+    weak = skimage.feature.canny(data, sigma, LOW_THRESHOLD * scale,
+                                 LOW_THRESHOLD * scale)[crop]
+    strong = skimage.feature.canny(data, sigma, HIGH_THRESHOLD * scale,
+                                   HIGH_THRESHOLD * scale)[crop]
+    labels, count = ndimage.label(weak, STRUCTURE, output=np.int32)
+    has_strong = np.zeros(count + 1, bool)
+    has_strong[labels[strong]] = True
+    return labels, count, has_strong
+
+
+def _seam_pairs(first, second):
+    # Pairs of labels that touch (8-connectivity) across a seam, first and
+    # second being the lines of pixels on each side.
+    pairs = list()
+    for shift in (-1, 0, 1):
+        a = first[max(shift, 0):len(first) + min(shift, 0)]
+        b = second[max(-shift, 0):len(second) + min(-shift, 0)]
+        touch = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touch], b[touch]]))
+    return np.concatenate(pairs, axis=1)
+
+
+def label_edges(image, sigma=3, mask=26, tile=1024, workers=None):
+    '''
+    Returns the label image (int32) of the canny edges of the image where the
+    pixels below mask are set to 0, computed on tiles of tile x tile pixels
+    by workers threads. It is the same as
+    measure.label(canny(image * (image >= mask), sigma)).
+    '''
+    labels = np.zeros(image.shape, np.int32)
+    good = [np.zeros(1, bool)]
+    nb_labels = 0
+    grid = list(tiles(image.shape, tile, overlap(sigma)))
+    with futures.ThreadPoolExecutor(workers) as executor:
+        jobs = executor.map(lambda slices: _tile_edges(image, sigma, mask,
+                                                       *slices), grid)
+        for (core, padded), (tile_labels, count, has_strong) in zip(grid,
+                                                                   jobs):
+            # The labels of the tiles are numbered after each other.
+            tile_labels[tile_labels > 0] += nb_labels
+            labels[core] = tile_labels
+            good.append(has_strong[1:])
+            nb_labels += count
+    good = np.concatenate(good)
+
+    # Merges the weak edges that touch across the seams, then keeps those
+    # holding a strong edge, as the hysteresis of canny.
+    pairs = [np.zeros((2, 0), np.int32)]
+    for seam in range(tile, image.shape[0], tile):
+        pairs.append(_seam_pairs(labels[seam - 1], labels[seam]))
+    for seam in range(tile, image.shape[1], tile):
+        pairs.append(_seam_pairs(labels[:, seam - 1], labels[:, seam]))
+    pairs = np.concatenate(pairs, axis=1)
+    graph = coo_matrix((np.ones(pairs.shape[1], bool), (pairs[0], pairs[1])),
+                       shape=(nb_labels + 1, nb_labels + 1))
+    _, component = connected_components(graph, directed=False)
+    good_component = np.bincount(component, weights=good,
+                                 minlength=component.max() + 1) > 0
+    edges = good_component[component][labels]
+
+    # Numbered as measure.label does, in the order of the image.
+    ndimage.label(edges, STRUCTURE, output=labels)
+    return labels
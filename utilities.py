@@ -1,9 +1,12 @@
+import threading
+import time
+
 from matplotlib import pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 import numpy as np
 from matplotlib.widgets import Slider
-from skimage import measure, exposure
-import skimage.feature
+
+from vessels import Vesselpyramid
 
 
 def register_fiji_cmap_red(name):
@@ -41,6 +44,90 @@ def register_fiji_cmap_green(name):
     plt.register_cmap(cmap=test_green_black)
 
 
+class Updatescheduler:
+    """
+    Runs the updates of an interactive figure on a worker thread. Calls to
+    request() that follow each other within delay seconds are coalesced into
+    one call to compute(*args), the result of a computation is dropped if a
+    newer request arrived in the meantime, and apply(result) is called on the
+    main thread, by a timer of the canvas, with the latest result only.
+
+    If refine is given, requests are computed with compute(*args,
+    preview=True) and, when no new request arrives within refine seconds,
+    once again with compute(*args, preview=False).
+    """
+
+    def __init__(self, fig, compute, apply, delay=0.05, refine=None):
+        self.compute = compute
+        self.apply = apply
+        self.delay = delay
+        self.refine = refine
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._generation = 0
+        self._pending = None
+        self._result = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._timer = fig.canvas.new_timer(interval=int(delay * 1000))
+        self._timer.add_callback(self._poll)
+        self._timer.start()
+        fig.canvas.mpl_connect('close_event', lambda event: self.stop())
+
+    def request(self, *args):
+        """
+        Asks for an update with the arguments args
+        """
+        with self._lock:
+            self._generation += 1
+            self._pending = (self._generation, args)
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stops the worker thread and the timer
+        """
+        self._stopped = True
+        self._wake.set()
+        self._timer.stop()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            if self._stopped:
+                return
+            # Waits for the slider to rest for delay before computing.
+            generation = None
+            while generation != self._generation:
+                generation = self._generation
+                time.sleep(self.delay)
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._wake.clear()
+            if pending is None:
+                continue
+            generation, args = pending
+            if self.refine is None:
+                self._publish(generation, self.compute(*args))
+                continue
+            self._publish(generation, self.compute(*args, preview=True))
+            # Refines the preview once the sliders rest.
+            if not self._wake.wait(self.refine):
+                self._publish(generation, self.compute(*args, preview=False))
+
+    def _publish(self, generation, result):
+        with self._lock:
+            if generation == self._generation:
+                self._result = (result,)
+
+    def _poll(self):
+        with self._lock:
+            result, self._result = self._result, None
+        if result is not None:
+            self.apply(result[0])
+
+
 def adjust_contrast(image, contrast=1):
     mid = (np.max(image) + np.min(image)) / 2
     return ((image - mid) * contrast) + mid
@@ -62,14 +149,19 @@ def mix_images(image_red, image_green):
 
     sfact = Slider(axfact, 'Factor', 0, 2, valinit=fact, valstep=0.01)
 
-    def _update(val):
-        # print(sfact.val)
-        update_im = np.where(image_red - (image_green * sfact.val) < 0, 0, image_red - (image_green * sfact.val))
-        # update_im = np.clip(image_red - (image_green * sfact.val), a_min=0, a_max=256)
+    def _compute(fact):
+        # print(fact)
+        return np.where(image_red - (image_green * fact) < 0, 0, image_red - (image_green * fact))
+        # update_im = np.clip(image_red - (image_green * fact), a_min=0, a_max=256)
+
+    def _apply(update_im):
         im1.set_data(update_im)
-        fig.canvas.draw()
+        fig.canvas.draw_idle()
 
-    sfact.on_changed(_update)
+    # The images are computed on a worker thread, so that dragging the
+    # slider does not block the figure.
+    scheduler = Updatescheduler(fig, _compute, _apply)
+    sfact.on_changed(lambda val: scheduler.request(sfact.val))
     plt.show()
 
 #
@@ -114,14 +206,16 @@ def adjustable_detector(image):
     brg0 = 0
 
     im1 = ax.imshow(image, cmap='imageJ-red-black')
-    edges0 = skimage.feature.canny(image=image, sigma=sig0)
-    segs0 = measure.regionprops(measure.label(edges0))
-    all_coords = np.zeros([1, 2])
-    for seg in segs0:
-        if seg.convex_area > size0:
-            all_coords = np.concatenate([seg.coords, all_coords])
-
-    outlines = ax.scatter(all_coords[:, 1], all_coords[:, 0], 0.1)
+    # Keeps the intermediate results, so that moving a slider only computes
+    # again the stages that depend on it. While the sliders move, the
+    # detection runs on a reduced image of the pyramid.
+    detector = Vesselpyramid(image)
+    # The vessels are drawn as an image layer over the image, where the
+    # pixels out of the vessels are masked.
+    vessels0 = detector.vessel_mask(sigma=sig0, mask=max0, min_area=size0)
+    outlines = ax.imshow(np.ma.masked_array(vessels0, ~vessels0),
+                         cmap=ListedColormap(['tab:blue']), vmin=0, vmax=1,
+                         interpolation='nearest')
 
     axcolor = 'lightgoldenrodyellow'
     axsig = fig.add_axes([0.25, 0.15, 0.65, 0.03], facecolor=axcolor)
@@ -138,23 +232,31 @@ def adjustable_detector(image):
     smax = Slider(axmax, 'Mask', 0, 256, valinit=max0, valstep=1)
     # sbrg = Slider(axbrg, 'Brightness', -128, 128, valinit=brg0, valstep=1)
 
-    def _update(val):
-        # update_im = np.clip(adjust_contrast(image * (image >= smax.val), contrast=smin.val) + sbrg.val, 0, 256) #!!!!
-        update_im = image * (image >= smax.val)
-        edges = skimage.feature.canny(image=update_im, sigma=ssig.val)
-        segs = measure.regionprops(measure.label(edges))
-        all_coords = np.zeros([1, 2])
-        qualified_segments = []
-        for seg in segs:
-            if seg.filled_area > ssize.val:
-                all_coords = np.concatenate([seg.coords, all_coords])
-                qualified_segments.append(seg)
-
-        outlines.set_offsets(np.flip(all_coords))
+    def _compute(sigma, mask, min_area, preview=False):
+        # update_im = np.clip(adjust_contrast(image * (image >= mask), contrast=smin.val) + sbrg.val, 0, 256) #!!!!
+        level = -1 if preview else 0
+        update_im = detector.masked(mask)
+        metrics = detector.measure(sigma=sigma, mask=mask, min_area=min_area,
+                                   level=level)
+        vessels = detector.vessel_mask(sigma=sigma, mask=mask,
+                                       min_area=min_area, level=level)
+        return update_im, metrics, vessels
+
+    def _apply(result):
+        update_im, metrics, vessels = result
+        outlines.set_data(np.ma.masked_array(vessels, ~vessels))
         im1.set_data(update_im)
-        ax.set_title(f'Average vessel width: {np.mean([seg.minor_axis_length for seg in qualified_segments])}'
-                     f'\nNumber of vessels: {len(qualified_segments)}')
-        fig.canvas.draw()
+        ax.set_title(f'Average vessel width: {metrics.average_width}'
+                     f'\nNumber of vessels: {metrics.count}')
+        fig.canvas.draw_idle()
+
+    # The detection runs on a worker thread, only the last position of the
+    # sliders is computed and drawn.
+    scheduler = Updatescheduler(fig, _compute, _apply,
+                                refine=0.5 if len(detector) > 1 else None)
+
+    def _update(val):
+        scheduler.request(ssig.val, smax.val, ssize.val)
 
     ssig.on_changed(_update)
     ssize.on_changed(_update)
@@ -0,0 +1,207 @@
+'''
+vessels measures the vessels of an image: masking, canny edge detection and
+region properties of the edges. It never imports matplotlib, so it can run in
+worker processes or on a server without display.
+
+>>> metrics = measure_vessels(image_data, sigma=3, mask=26, min_area=25)
+>>> print(metrics.count, metrics.average_width)
+
+To try several parameters on the same image, a Vesseldetector only computes
+again what depends on the parameters that changed :
+
+>>> detector = Vesseldetector(image_data)
+>>> metrics = detector.measure(sigma=3, mask=26, min_area=25)
+>>> metrics = detector.measure(sigma=3, mask=26, min_area=40)
+
+A Vesselpyramid previews the detection on a reduced image, with the widths
+still in pixels of the full image :
+
+>>> pyramid = Vesselpyramid(image_data)
+>>> preview = pyramid.measure(sigma=3, mask=26, min_area=25, level=-1)
+'''
+from collections import namedtuple
+
+import numpy as np
+from skimage import measure
+import skimage.feature
+
+from regions import Regionstats
+import tiled
+
+VesselMetrics = namedtuple('VesselMetrics',
+                           ['count', 'average_width', 'widths', 'segments'])
+VesselMetrics.__doc__ = '''
+Vessels found in an image: their number, their average width, the width of
+each vessel and its region properties (skimage.measure.regionprops), as a
+regions.Regionlist created when read.
+'''
+
+
+def measure_vessels(image, sigma=3, mask=26, min_area=25, tile=None,
+                    workers=None):
+    """
+    Finds the vessels of an image
+    :param image: image with pixel values in the range 0 to 256
+    :param sigma: sigma of the canny edge detector
+    :param mask: pixels below this value are ignored
+    :param min_area: minimal filled area of a vessel
+    :param tile: if given, the edges are detected on tiles of tile x tile
+        pixels (see tiled.label_edges), for images too big for the memory
+    :param workers: number of threads detecting the edges of the tiles
+    :return: VesselMetrics
+    """
+    return Vesseldetector(image, tile, workers).measure(sigma, mask, min_area)
+
+
+class Vesseldetector:
+    """
+    Finds the vessels of an image stage by stage, keeping the last result of
+    each stage: the masked image depends on mask, the edges on (mask, sigma)
+    and the regions on the edges. When the parameters change, only the
+    stages after the first changed parameter are computed again, e.g. a new
+    min_area only filters the regions again.
+
+    If tile is given, the labels of the edges are computed on tiles by
+    tiled.label_edges, without the masked image and the edges of the whole
+    image.
+    """
+
+    def __init__(self, image, tile=None, workers=None):
+        self.image = image
+        self.tile = tile
+        self.workers = workers
+        self._stages = dict()
+
+    def _cached(self, stage, key, compute):
+        # Only the last result of each stage is kept: on big images, each
+        # of them is as big as the image.
+        if stage not in self._stages or self._stages[stage][0] != key:
+            self._stages[stage] = (key, compute())
+        return self._stages[stage][1]
+
+    def masked(self, mask):
+        """
+        Returns the image where the pixels below mask are set to 0
+        """
+        return self._cached('masked', mask,
+                            lambda: self.image * (self.image >= mask))
+
+    def edges(self, sigma, mask):
+        """
+        Returns the canny edges of the masked image
+        """
+        return self._cached('edges', (mask, sigma),
+                            lambda: skimage.feature.canny(
+                                image=self.masked(mask), sigma=sigma))
+
+    def labels(self, sigma, mask):
+        """
+        Returns the label image of the connected edges
+        """
+        if self.tile is not None:
+            return self._cached('labels', (mask, sigma),
+                                lambda: tiled.label_edges(self.image, sigma,
+                                                          mask, self.tile,
+                                                          self.workers))
+        return self._cached('labels', (mask, sigma),
+                            lambda: measure.label(self.edges(sigma, mask)))
+
+    def regions(self, sigma, mask):
+        """
+        Returns the statistics of the connected edges (regions.Regionstats)
+        """
+        return self._cached('regions', (mask, sigma),
+                            lambda: Regionstats(self.labels(sigma, mask)))
+
+    def selected(self, sigma, mask, min_area):
+        """
+        Returns the labels of the regions kept as vessels, shared by measure
+        and vessel_mask
+        """
+        return self._cached('selected', (mask, sigma, min_area),
+                            lambda: self.regions(sigma, mask).select(min_area))
+
+    def measure(self, sigma=3, mask=26, min_area=25):
+        """
+        Finds the vessels of the image, see measure_vessels
+        """
+        stats = self.regions(sigma, mask)
+        selected = self.selected(sigma, mask, min_area)
+        widths = stats.minor_axis_length[selected].tolist()
+        return VesselMetrics(count=len(selected),
+                             average_width=np.mean(widths) if widths else np.nan,
+                             widths=widths,
+                             segments=stats.regionprops(selected))
+
+    def vessel_mask(self, sigma=3, mask=26, min_area=25):
+        """
+        Returns the boolean image of the pixels of the vessels
+        """
+        return self.regions(sigma, mask).mask(
+                    self.selected(sigma, mask, min_area))
+
+
+def _reduce(image):
+    # Means of the blocks of 2 x 2 pixels, the last row and column being
+    # repeated when the image has an odd size.
+    image = np.pad(image, [(0, image.shape[0] % 2), (0, image.shape[1] % 2)],
+                   mode='edge')
+    return image.reshape(image.shape[0] // 2, 2,
+                         image.shape[1] // 2, 2).mean(axis=(1, 3))
+
+
+class Vesselpyramid:
+    """
+    Vessel detectors on the image and on reductions of it by 2, 4, ...,
+    built once, to preview the detection quickly. The reductions are added
+    until the largest side is at most preview_size. On a level reduced by f,
+    sigma is divided by f and min_area by f ** 2, and the widths are
+    multiplied by f, so that they stay in pixels of the full image. The
+    segments stay in pixels of the level.
+    """
+
+    def __init__(self, image, preview_size=1024):
+        self.shape = image.shape
+        self.detectors = [Vesseldetector(image)]
+        while max(self.detectors[-1].image.shape) > preview_size:
+            self.detectors.append(
+                Vesseldetector(_reduce(self.detectors[-1].image)))
+
+    def __len__(self):
+        return len(self.detectors)
+
+    def factor(self, level):
+        """
+        Returns the reduction factor of a level
+        """
+        return 2 ** range(len(self.detectors))[level]
+
+    def masked(self, mask):
+        """
+        Returns the full image where the pixels below mask are set to 0
+        """
+        return self.detectors[0].masked(mask)
+
+    def measure(self, sigma=3, mask=26, min_area=25, level=0):
+        """
+        Finds the vessels on a level of the pyramid, see measure_vessels
+        """
+        factor = self.factor(level)
+        metrics = self.detectors[level].measure(sigma / factor, mask,
+                                                min_area / factor ** 2)
+        widths = [width * factor for width in metrics.widths]
+        return metrics._replace(
+                    average_width=np.mean(widths) if widths else np.nan,
+                    widths=widths)
+
+    def vessel_mask(self, sigma=3, mask=26, min_area=25, level=0):
+        """
+        Returns the boolean image of the pixels of the vessels found on a
+        level, at the size of the full image
+        """
+        factor = self.factor(level)
+        vessels = self.detectors[level].vessel_mask(sigma / factor, mask,
+                                                    min_area / factor ** 2)
+        if factor > 1:
+            vessels = vessels.repeat(factor, 0).repeat(factor, 1)
+        return vessels[:self.shape[0], :self.shape[1]]